@@ -0,0 +1,40 @@
+import os
+import tempfile
+import time
+from typing import List
+
+from benchmarks.report import peak_rss_mb, summarize
+from benchmarks.synthetic_pdf import make_pdf
+from src.utils.pdf_processor import PDF_WORKERS, extract_text_from_pdf, shutdown_pool
+
+# extract_text_from_pdf throughput on synthetic PDFs of several sizes.
+
+
+def run(page_counts: List[int], repeats: int = 3, lines: int = 40) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="cag-bench-") as workdir:
+        for pages in page_counts:
+            path = os.path.join(workdir, f"synthetic_{pages}.pdf")
+            size = make_pdf(path, pages, lines=lines)
+            extract_text_from_pdf(path)  # warm up imports and, for large files, the process pool
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(repeats):
+                call_started = time.perf_counter()
+                text = extract_text_from_pdf(path)
+                latencies.append(time.perf_counter() - call_started)
+                if not text or not text.strip():
+                    raise RuntimeError(f"Extraction of the {pages}-page PDF returned no text")
+            wall = time.perf_counter() - started
+            summary = summarize(latencies, wall)
+            results[f"{pages}_pages"] = {
+                "pages": pages,
+                "bytes": size,
+                "p50_ms": summary["p50_ms"],
+                "p95_ms": summary["p95_ms"],
+                "pages_per_s": round(pages * repeats / wall, 1),
+                "mb_per_s": round(size * repeats / wall / 1024 / 1024, 2),
+            }
+    shutdown_pool()
+    results["process"] = {"workers": PDF_WORKERS, "peak_rss_mb": peak_rss_mb()}
+    return results
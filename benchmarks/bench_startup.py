@@ -0,0 +1,151 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import httpx
+
+from benchmarks.load_test import REPO_ROOT, _free_port
+from benchmarks.report import summarize
+
+# Cold start: how long `import main` takes in a fresh interpreter and how much
+# memory it leaves resident, then how long a multi-worker uvicorn server takes
+# to serve its first request and what each worker costs in RSS.
+
+HEAVY_MODULES = ("pypdf", "dotenv", "tiktoken")
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+seconds = time.perf_counter() - started
+rss_kb = 0
+with open("/proc/self/status") as fh:
+    for line in fh:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({"seconds": seconds, "rss_mb": rss_kb / 1024,
+                  "loaded": [name for name in %r if name in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def _rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as fh:
+            return [int(child) for child in fh.read().split()]
+    except OSError:
+        return []
+
+
+def _app_workers(pid: int) -> List[int]:
+    # Children of the uvicorn master, minus multiprocessing's resource tracker
+    workers = []
+    for child in _children(pid):
+        try:
+            with open(f"/proc/{child}/cmdline", "rb") as fh:
+                if b"resource_tracker" in fh.read():
+                    continue
+        except OSError:
+            continue
+        workers.append(child)
+    return workers
+
+
+def _median(values: List[float]) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[len(ordered) // 2], 1)
+
+
+def _import_times(repeats: int, env: dict) -> dict:
+    latencies = []
+    rss = []
+    loaded = set()
+    started = time.perf_counter()
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", _IMPORT_PROBE], cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        probe = json.loads(output.strip().splitlines()[-1])
+        latencies.append(probe["seconds"])
+        rss.append(probe["rss_mb"])
+        loaded.update(probe["loaded"])
+    summary = summarize(latencies, time.perf_counter() - started)
+    return {
+        "p50_ms": summary["p50_ms"],
+        "p95_ms": summary["p95_ms"],
+        "max_ms": summary["max_ms"],
+        "rss_mb": _median(rss),
+        "heavy_modules_loaded": sorted(loaded),
+    }
+
+
+def _server_start(workers: int, env: dict, timeout: float = 60.0) -> dict:
+    # The master binds the port before the workers have imported the app, so
+    # readiness is the first successful response, not the first connection
+    port = _free_port()
+    args = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning"]
+    started = time.perf_counter()
+    process = subprocess.Popen(args, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready = None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and process.poll() is None:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1.0).status_code == 200:
+                    ready = time.perf_counter() - started
+                    break
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.05)
+        if ready is None:
+            raise RuntimeError(f"uvicorn with {workers} workers did not serve / within {timeout}s")
+        # Let the remaining workers finish importing before measuring them
+        time.sleep(1.0)
+        # With --workers the master only supervises; the app runs in its children
+        worker_pids = _app_workers(process.pid) if workers > 1 else [process.pid]
+        worker_rss = [rss for rss in map(_rss_mb, worker_pids) if rss is not None]
+        master_rss = _rss_mb(process.pid) if workers > 1 else 0
+        return {
+            "ready_ms": round(ready * 1000, 2),
+            "workers": len(worker_rss),
+            "per_worker_rss_mb": _median(worker_rss),
+            "total_rss_mb": round(sum(worker_rss) + (master_rss or 0), 1),
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run(repeats: int = 5, workers: int = 4, store: str = "memory") -> dict:
+    env = dict(os.environ)
+    env["CAG_STORE_BACKEND"] = store
+    with tempfile.TemporaryDirectory(prefix="cag-startup-") as workdir:
+        env.setdefault("CAG_STORE_PATH", os.path.join(workdir, "store.db"))
+        return {
+            "import": _import_times(repeats, env),
+            "server": _server_start(workers, env),
+        }
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
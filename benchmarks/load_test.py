@@ -0,0 +1,215 @@
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid as uuid_pkg
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Iterator, List, Tuple
+
+import httpx
+
+from benchmarks.report import peak_rss_mb, summarize
+from benchmarks.synthetic_pdf import make_pdf
+
+# Drives the API over HTTP under concurrent load.
+# The mock chat-completions server and the app each run in their own uvicorn
+# subprocess, so the app's peak RSS is measured on its own and the driver does
+# not compete with it for the GIL.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUESTIONS = [
+    "What are the payment terms?",
+    "Who are the parties to the agreement?",
+    "What is the notice period?",
+    "Summarize the liability clause.",
+    "What does the report say about revenue growth?",
+    "Which risks are mentioned?",
+    "What is the delivery schedule?",
+    "What are the data retention rules?",
+    "How is compliance audited?",
+    "What is the budget forecast?",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_listening(port: int, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server on port {port} exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start within {timeout}s")
+
+
+@contextmanager
+def _server(args: List[str], port: int, env: Dict[str, str]) -> Iterator[subprocess.Popen]:
+    process = subprocess.Popen(
+        [sys.executable] + args, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_until_listening(port, process)
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def _drive(total: int, concurrency: int, request: Callable[[int], Awaitable[None]]) -> Tuple[List[float], int, float]:
+    # Runs request(0..total-1) with at most `concurrency` in flight; returns latencies, errors and wall time
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(index: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await request(index)
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"Request {index} failed: {e!r}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(total)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def _wait_for_job(client: httpx.AsyncClient, job_id: str, timeout: float = 300.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = (await client.get(f"/api/v1/jobs/{job_id}")).json()
+        if job["status"] not in ("queued", "running"):
+            if job["status"] != "done":
+                raise RuntimeError(f"Ingestion job {job_id} {job['status']}: {job.get('error')}")
+            return job
+        await asyncio.sleep(0.05)
+    raise RuntimeError(f"Ingestion job {job_id} did not finish within {timeout}s")
+
+
+async def _scenarios(base_url: str, pdfs: List[bytes], update_pdf: bytes, options: dict) -> Dict[str, dict]:
+    documents = [str(uuid_pkg.uuid4()) for _ in pdfs]
+    questions = QUESTIONS[: max(1, options["distinct_questions"])]
+    concurrency = options["concurrency"]
+    rng = random.Random(0)
+    results = {}
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0, limits=limits) as client:
+        async def upload(index: int) -> None:
+            files = {"file": (f"doc{index}.pdf", pdfs[index], "application/pdf")}
+            response = await client.post(f"/api/v1/upload/{documents[index]}", files=files)
+            response.raise_for_status()
+            await _wait_for_job(client, response.json()["job_id"])
+
+        latencies, errors, wall = await _drive(len(documents), concurrency, upload)
+        results["upload_and_ingest"] = summarize(latencies, wall, errors)
+
+        async def query(index: int) -> None:
+            params = {"query": rng.choice(questions), "mode": options["mode"]}
+            response = await client.get(f"/api/v1/query/{rng.choice(documents)}", params=params)
+            response.raise_for_status()
+
+        latencies, errors, wall = await _drive(options["requests"], concurrency, query)
+        results["query"] = summarize(latencies, wall, errors)
+
+        first_token = []
+
+        async def stream(index: int) -> None:
+            # Unique questions so every stream reaches the provider
+            params = {"query": f"{rng.choice(questions)} (stream {index})", "stream": "true", "mode": options["mode"]}
+            started = time.perf_counter()
+            async with client.stream("GET", f"/api/v1/query/{rng.choice(documents)}", params=params) as response:
+                response.raise_for_status()
+                seen_token = False
+                async for line in response.aiter_lines():
+                    if line.startswith("event: error"):
+                        raise RuntimeError("Stream ended with an error event")
+                    if not seen_token and line.startswith("data:"):
+                        first_token.append(time.perf_counter() - started)
+                        seen_token = True
+
+        stream_requests = max(1, options["requests"] // 4)
+        latencies, errors, wall = await _drive(stream_requests, concurrency, stream)
+        results["query_stream"] = summarize(latencies, wall, errors)
+        time_to_first_token = summarize(first_token, wall)
+        del time_to_first_token["throughput_per_s"]  # same as query_stream
+        results["query_stream_first_token"] = time_to_first_token
+
+        async def batch(index: int) -> None:
+            body = {"questions": rng.sample(questions, min(len(questions), 5)), "mode": options["mode"]}
+            response = await client.post(f"/api/v1/query/{documents[index % len(documents)]}/batch", json=body)
+            response.raise_for_status()
+
+        latencies, errors, wall = await _drive(max(1, options["requests"] // 10), concurrency, batch)
+        results["query_batch"] = summarize(latencies, wall, errors)
+
+        async def update(index: int) -> None:
+            files = {"file": ("update.pdf", update_pdf, "application/pdf")}
+            response = await client.put(f"/api/v1/update/{documents[index]}", files=files)
+            response.raise_for_status()
+            await _wait_for_job(client, response.json()["job_id"])
+
+        latencies, errors, wall = await _drive(len(documents), concurrency, update)
+        results["update_and_ingest"] = summarize(latencies, wall, errors)
+
+        async def delete(index: int) -> None:
+            response = await client.delete(f"/api/v1/data/{documents[index]}")
+            response.raise_for_status()
+
+        latencies, errors, wall = await _drive(len(documents), concurrency, delete)
+        results["delete"] = summarize(latencies, wall, errors)
+    return results
+
+
+def run(options: dict) -> dict:
+    mock_port = _free_port()
+    app_port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        "CAG_LLM_PROVIDER": "openrouter",
+        "CAG_LLM_API_BASE": f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+        "OPENROUTER_API_KEY": env.get("OPENROUTER_API_KEY", "benchmark"),
+        "CAG_STORE_BACKEND": options["store"],
+    })
+    pdfs = []
+    with tempfile.TemporaryDirectory(prefix="cag-load-") as workdir:
+        env.setdefault("CAG_STORE_PATH", os.path.join(workdir, "store.db"))
+        for index in range(options["documents"]):
+            path = os.path.join(workdir, f"doc{index}.pdf")
+            make_pdf(path, options["pages"], seed=index)
+            with open(path, "rb") as fh:
+                pdfs.append(fh.read())
+        update_path = os.path.join(workdir, "update.pdf")
+        make_pdf(update_path, max(1, options["pages"] // 10), seed=10_000)
+        with open(update_path, "rb") as fh:
+            update_pdf = fh.read()
+
+        mock_args = [
+            "-m", "benchmarks.mock_llm", "--port", str(mock_port),
+            "--latency", str(options["llm_latency"]), "--token-delay", str(options["token_delay"]),
+            "--completion-tokens", str(options["completion_tokens"]),
+        ]
+        app_args = ["-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"]
+        with _server(mock_args, mock_port, env), _server(app_args, app_port, env) as app_process:
+            results = asyncio.run(_scenarios(f"http://127.0.0.1:{app_port}", pdfs, update_pdf, options))
+            results["app_process"] = {"peak_rss_mb": peak_rss_mb(app_process.pid)}
+    return results
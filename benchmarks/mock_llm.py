@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Local stand-in for an OpenAI-compatible chat-completions endpoint.
+# Answers after a configurable delay, optionally streams tokens with a
+# per-token delay, and reports usage like a provider with a prompt cache, so
+# the app can be load-tested without network access or API costs.
+
+app = FastAPI(title="Mock chat completions")
+
+settings = {
+    "latency": 0.2,          # seconds before the first byte
+    "token_delay": 0.01,     # seconds between streamed tokens
+    "completion_tokens": 50,
+    "error_rate": 0.0,       # share of requests answered with HTTP 503
+    "cached_ratio": 0.8,     # share of prompt tokens reported as cached after the first request for a prompt
+}
+_seen_prefixes = set()
+_QUESTION_RE = re.compile(r"^\d+\. ", re.MULTILINE)
+
+
+def _prompt_text(body: dict) -> str:
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content)
+        else:
+            parts.append(content or "")
+    return "\n".join(parts)
+
+
+def _usage(body: dict) -> dict:
+    messages = body.get("messages", [])
+    prefix = json.dumps(messages[:-1], sort_keys=True)
+    prompt_tokens = max(1, len(_prompt_text(body)) // 4)
+    cached = int(prompt_tokens * settings["cached_ratio"]) if prefix in _seen_prefixes else 0
+    _seen_prefixes.add(prefix)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": settings["completion_tokens"],
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def _answer(body: dict) -> str:
+    if body.get("response_format", {}).get("type") == "json_object":
+        # Packed batch question: one answer per numbered question
+        questions = len(_QUESTION_RE.findall(body["messages"][-1]["content"]))
+        return json.dumps({"answers": [f"Mock answer {number}." for number in range(1, questions + 1)]})
+    return " ".join(["mock"] * settings["completion_tokens"])
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(settings["latency"])
+    if random.random() < settings["error_rate"]:
+        return JSONResponse(status_code=503, content={"error": {"message": "mock overload"}})
+    answer = _answer(body)
+    usage = _usage(body)
+    if not body.get("stream"):
+        return {
+            "id": "mock",
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def events():
+        for token in answer.split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": token + " "}}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(settings["token_delay"])
+        yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", **settings}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the mock chat-completions server")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=settings["latency"])
+    parser.add_argument("--token-delay", type=float, default=settings["token_delay"])
+    parser.add_argument("--completion-tokens", type=int, default=settings["completion_tokens"])
+    parser.add_argument("--error-rate", type=float, default=settings["error_rate"])
+    parser.add_argument("--cached-ratio", type=float, default=settings["cached_ratio"])
+    args = parser.parse_args()
+    settings.update(
+        latency=args.latency, token_delay=args.token_delay, completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate, cached_ratio=args.cached_ratio,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
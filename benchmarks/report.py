@@ -0,0 +1,94 @@
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Dict, List, Optional
+
+# Result summaries and baseline comparison.
+# Every benchmark reports one flat dict per scenario; lower is better for
+# latency and RSS, higher is better for throughput.
+
+HIGHER_IS_BETTER = ("throughput_per_s", "pages_per_s", "mb_per_s")
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(latencies: List[float], wall_seconds: float, errors: int = 0) -> dict:
+    # Latencies in seconds in, milliseconds out
+    def ms(value: Optional[float]) -> Optional[float]:
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(max(latencies) if latencies else None),
+        "throughput_per_s": round(len(latencies) / wall_seconds, 2) if wall_seconds > 0 else None,
+    }
+
+
+def peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    # Peak resident set size of another process (Linux /proc) or of this process and its children
+    if pid is not None:
+        try:
+            with open(f"/proc/{pid}/status") as fh:
+                for line in fh:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / scale, 1)
+
+
+def environment() -> dict:
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    # Regressions beyond tolerance (a fraction, e.g. 0.1 for 10%) for every metric both runs have
+    regressions = []
+    for section, scenarios in current.get("results", {}).items():
+        for scenario, metrics in scenarios.items():
+            previous = baseline.get("results", {}).get(section, {}).get(scenario)
+            if not previous:
+                continue
+            for name, value in metrics.items():
+                old = previous.get(name)
+                if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+                    continue
+                if name in ("requests", "errors", "pages", "bytes", "workers"):
+                    continue
+                change = (value - old) / old
+                worse = -change if name in HIGHER_IS_BETTER else change
+                if worse > tolerance:
+                    regressions.append(f"{section}/{scenario}/{name}: {old} -> {value} ({change:+.1%})")
+    return regressions
+
+
+def write_report(report: Dict, path: Optional[str]) -> None:
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, "w") as fh:
+            fh.write(text + "\n")
+    print(text)
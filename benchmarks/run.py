@@ -0,0 +1,60 @@
+import argparse
+import json
+import sys
+
+from benchmarks import bench_extraction, bench_startup, load_test
+from benchmarks.report import compare, environment, write_report
+
+# Entry point: python -m benchmarks.run [options]
+# Writes one JSON report; with --baseline, exits with status 1 when any metric
+# regressed by more than --tolerance compared with an earlier report.
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="CAG extraction and startup benchmarks and API load test")
+    parser.add_argument("--suite", choices=("all", "extraction", "startup", "load"), default="all")
+    parser.add_argument("--extract-pages", default="10,100,500", help="Comma-separated page counts for extraction")
+    parser.add_argument("--extract-repeats", type=int, default=3)
+    parser.add_argument("--startup-repeats", type=int, default=5, help="Fresh interpreters timed importing the app")
+    parser.add_argument("--workers", type=int, default=4, help="uvicorn workers in the startup benchmark")
+    parser.add_argument("--documents", type=int, default=5, help="Documents uploaded in the load test")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per load-test document")
+    parser.add_argument("--requests", type=int, default=200, help="Query requests in the load test")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--distinct-questions", type=int, default=10, help="Fewer questions means more answer-cache hits")
+    parser.add_argument("--mode", choices=("auto", "full", "retrieval"), default="auto")
+    parser.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Mock provider time to first byte, seconds")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Mock provider delay per streamed token")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression, e.g. 0.10 for 10%%")
+    args = parser.parse_args()
+
+    options = vars(args)
+    report = {"environment": environment(), "options": options, "results": {}}
+    if args.suite in ("all", "extraction"):
+        page_counts = [int(pages) for pages in args.extract_pages.split(",") if pages]
+        report["results"]["extraction"] = bench_extraction.run(page_counts, args.extract_repeats)
+    if args.suite in ("all", "startup"):
+        report["results"]["startup"] = bench_startup.run(args.startup_repeats, args.workers, args.store)
+    if args.suite in ("all", "load"):
+        report["results"]["load"] = load_test.run(options)
+    write_report(report, args.output)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import argparse
+import random
+
+# Synthetic PDFs for benchmarks.
+# Writes a minimal PDF by hand (one Helvetica text stream per page) so no PDF
+# writer library is needed. The text is pseudo-random prose from a fixed
+# vocabulary, seeded, so runs with the same arguments produce identical files.
+
+VOCABULARY = (
+    "the contract supplier invoice payment term delivery clause party agreement notice period "
+    "liability warranty service level report revenue quarter budget forecast risk audit policy "
+    "customer product release schedule milestone review approval compliance data security access "
+    "incident response training record storage retention region market growth cost margin"
+).split()
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _page_lines(rng: random.Random, page_number: int, lines: int, words_per_line: int) -> list:
+    body = []
+    for _ in range(lines):
+        words = [rng.choice(VOCABULARY) for _ in range(words_per_line)]
+        body.append(" ".join(words).capitalize() + ".")
+    # Running header and footer, like most real reports
+    return ["Synthetic Benchmark Report"] + body + [f"Page {page_number}"]
+
+
+def make_pdf(path: str, pages: int, lines: int = 40, words_per_line: int = 12, seed: int = 0) -> int:
+    # Returns the file size in bytes
+    rng = random.Random(seed)
+    out = [b"%PDF-1.4\n"]
+    offsets = {}
+
+    def add(number: int, body: bytes) -> None:
+        offsets[number] = sum(len(part) for part in out)
+        out.append(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    # 1 catalog, 2 page tree, 3 font, then a page object and a content stream per page
+    page_numbers = [4 + 2 * index for index in range(pages)]
+    add(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{number} 0 R" for number in page_numbers)
+    add(2, f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    add(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for index, number in enumerate(page_numbers):
+        text_lines = _page_lines(rng, index + 1, lines, words_per_line)
+        stream = ("BT /F1 9 Tf 40 770 Td 11 TL " + " ".join(f"({_escape(line)}) '" for line in text_lines) + " ET").encode()
+        add(number, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {number + 1} 0 R >>"
+        ).encode())
+        add(number + 1, f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+
+    xref_offset = sum(len(part) for part in out)
+    size = max(offsets) + 1
+    xref = [f"xref\n0 {size}\n0000000000 65535 f \n"] + [f"{offsets[number]:010d} 00000 n \n" for number in range(1, size)]
+    out.append("".join(xref).encode() + f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+    data = b"".join(out)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    return len(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic PDF")
+    parser.add_argument("path")
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(f"Wrote {make_pdf(args.path, args.pages, args.lines, seed=args.seed)} bytes to {args.path}")
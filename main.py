@@ -1,13 +1,34 @@
-from fastapi import FastAPI
+import gzip
+import hashlib
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from src.routers.data_handler import router
+from src.routers.metrics import router as metrics_router, MetricsMiddleware
+from src.utils.llm_client import close_client
+from src.utils.pdf_processor import shutdown_pool
+from src.startup import preload
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Close the shared LLM connection pool and the PDF extraction workers
+    await close_client()
+    shutdown_pool()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="CAG Project API - Chat with your PDF",
     description="Advanced API for uploading PDFs, querying content via LLM, and managing data with modern UI.",
     version="0.1.0",
 )
 
+# Request timing for /metrics
+app.add_middleware(MetricsMiddleware)
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -17,9 +38,9 @@ app.include_router(
     tags=["Data Handling And Chat with PDF"],
 )
 
-@app.get("/", response_class=HTMLResponse, tags=["Root"])
-def read_root():
-    html_content = """
+app.include_router(metrics_router, tags=["Monitoring"])
+
+LANDING_PAGE_HTML = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -273,7 +294,29 @@ def read_root():
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content, status_code=200)
+
+# The landing page never changes while the server runs: encode it, gzip it and hash it
+# once at import instead of rebuilding the string on every request
+LANDING_PAGE = LANDING_PAGE_HTML.encode("utf-8")
+LANDING_PAGE_GZIP = gzip.compress(LANDING_PAGE, compresslevel=9, mtime=0)
+# Weak, since the plain and gzip bodies are the same page
+LANDING_PAGE_ETAG = f'W/"{hashlib.sha256(LANDING_PAGE).hexdigest()[:16]}"'
+
+
+@app.get("/", response_class=HTMLResponse, tags=["Root"])
+async def read_root(request: Request):
+    headers = {"ETag": LANDING_PAGE_ETAG, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or LANDING_PAGE_ETAG in if_none_match:
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(content=LANDING_PAGE_GZIP, status_code=200, headers=headers)
+    return HTMLResponse(content=LANDING_PAGE, status_code=200, headers=headers)
+
+
+# Warm the persisted store and freeze long-lived objects before workers fork
+preload_stats = preload()
 
 if __name__ == "__main__":
     import uvicorn
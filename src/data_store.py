@@ -1 +1,505 @@
-data_store={}
\ No newline at end of file
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid as uuid_pkg
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from src.utils.metrics import stage_seconds
+from src.utils.tokens import count_tokens
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always available
+    zstandard = None
+
+# Shared document store.
+# The router only talks to DocumentStore; where the bytes live is decided by
+# the backend picked from CAG_STORE_BACKEND:
+#   memory - in-process dict with a byte budget, LRU entries spill to a scratch SQLite file
+#   sqlite - on-disk SQLite (WAL) with compressed values, shared by every worker process
+
+STORE_BACKEND = os.environ.get("CAG_STORE_BACKEND", "memory")
+STORE_PATH = os.environ.get("CAG_STORE_PATH", "/tmp/cag_store/documents.sqlite3")
+STORE_SPILL_DIR = os.environ.get("CAG_STORE_SPILL_DIR", "/tmp/cag_store")
+STORE_MEMORY_BUDGET = int(os.environ.get("CAG_STORE_MEMORY_BUDGET", str(256 * 1024 * 1024)))
+STORE_ZSTD_LEVEL = int(os.environ.get("CAG_STORE_ZSTD_LEVEL", "3"))
+
+
+def _compress(data: bytes) -> bytes:
+    # One-byte codec tag so a store written with zstd can still be read without it and vice versa
+    if zstandard is not None:
+        return b"Z" + zstandard.ZstdCompressor(level=STORE_ZSTD_LEVEL).compress(data)
+    return b"z" + zlib.compress(data, 6)
+
+
+def _decompress(blob: bytes) -> bytes:
+    codec, payload = blob[:1], blob[1:]
+    if codec == b"Z":
+        if zstandard is None:
+            raise RuntimeError("Document store was written with zstd; install 'zstandard' to read it.")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if codec == b"z":
+        return zlib.decompress(payload)
+    return payload
+
+
+class StoreBackend:
+    # Namespaced key/value storage of raw bytes
+
+    name = "base"
+
+    def get(self, ns: str, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, ns: str, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+    def delete(self, ns: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def keys(self, ns: str) -> List[str]:
+        raise NotImplementedError
+
+    def count(self, ns: str) -> int:
+        raise NotImplementedError
+
+    def size_bytes(self) -> int:
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        # Releases open handles (e.g. database connections) before the process forks
+        pass
+
+
+class SQLiteBackend(StoreBackend):
+    name = "sqlite"
+
+    def __init__(self, path: str, compress: bool = True):
+        self.path = path
+        self.compress = compress
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # A connection must never cross a fork (SQLite can corrupt the file), so a forked
+        # child forgets the inherited ones and opens its own on first use
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shareable across threads, so keep one per thread,
+        # opened lazily so importing the store does not open the database
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Map the file so workers reading the same documents share the OS page cache
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " ns TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL,"
+                " PRIMARY KEY (ns, key)) WITHOUT ROWID"
+            )
+            # size is stored after value, so reading it from the table walks each value's
+            # overflow pages; counts and byte totals read this covering index instead
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_ns_size ON kv (ns, size)")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def _forget_connections(self) -> None:
+        # In a forked child: drop, but do not close, the parent's connections. Closing
+        # them would release the parent's file locks.
+        self._local = threading.local()
+
+    def close(self) -> None:
+        # Closes the calling thread's connection; the next access opens a new one
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not self._local.depth:
+            conn.close()
+            self._local.conn = None
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        # BEGIN IMMEDIATE takes the write lock up front, serialising writers across processes
+        conn = self._conn()
+        if self._local.depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("COMMIT")
+
+    def get(self, ns: str, key: str) -> Optional[bytes]:
+        row = self._conn().execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        if row is None:
+            return None
+        return _decompress(row[0]) if self.compress else row[0]
+
+    def put(self, ns: str, key: str, value: bytes) -> None:
+        stored = _compress(value) if self.compress else value
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (ns, key, value, size) VALUES (?, ?, ?, ?)",
+            (ns, key, stored, len(value)),
+        )
+
+    def delete(self, ns: str, key: str) -> bool:
+        cursor = self._conn().execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+        return cursor.rowcount > 0
+
+    def keys(self, ns: str) -> List[str]:
+        return [row[0] for row in self._conn().execute("SELECT key FROM kv WHERE ns = ? ORDER BY key", (ns,))]
+
+    def count(self, ns: str) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM kv INDEXED BY kv_ns_size WHERE ns = ?", (ns,)).fetchone()[0]
+
+    def size_bytes(self) -> int:
+        row = self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM kv INDEXED BY kv_ns_size").fetchone()
+        return int(row[0])
+
+
+class MemoryBackend(StoreBackend):
+    name = "memory"
+
+    def __init__(self, budget_bytes: int = STORE_MEMORY_BUDGET, spill_dir: str = STORE_SPILL_DIR):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self._items = OrderedDict()  # (ns, key) -> bytes, least recently used first
+        self._bytes = 0
+        self._spill = None
+        self._spill_path = None
+        self._spilled = set()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self._lock:
+            yield
+
+    def _spill_backend(self) -> SQLiteBackend:
+        # Scratch file private to this process; it is not a persistence layer
+        if self._spill is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, self._spill_path = tempfile.mkstemp(prefix=f"spill-{os.getpid()}-", suffix=".sqlite3", dir=self.spill_dir)
+            os.close(fd)
+            self._spill = SQLiteBackend(self._spill_path)
+            atexit.register(self._remove_spill_file)
+        return self._spill
+
+    def _remove_spill_file(self) -> None:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self._spill_path + suffix)
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        # Spill least recently used entries until we are back under budget; always keep the newest one
+        while self._bytes > self.budget_bytes and len(self._items) > 1:
+            (ns, key), value = self._items.popitem(last=False)
+            self._bytes -= len(value)
+            self._spill_backend().put(ns, key, value)
+            self._spilled.add((ns, key))
+
+    def get(self, ns: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._items.get((ns, key))
+            if value is not None:
+                self._items.move_to_end((ns, key))
+                return value
+            if (ns, key) not in self._spilled:
+                return None
+            # Promote back into memory
+            value = self._spill.get(ns, key)
+            self._spill.delete(ns, key)
+            self._spilled.discard((ns, key))
+            self._items[(ns, key)] = value
+            self._bytes += len(value)
+            self._evict()
+            return value
+
+    def put(self, ns: str, key: str, value: bytes) -> None:
+        with self._lock:
+            self.delete(ns, key)
+            self._items[(ns, key)] = value
+            self._bytes += len(value)
+            self._evict()
+
+    def delete(self, ns: str, key: str) -> bool:
+        with self._lock:
+            value = self._items.pop((ns, key), None)
+            if value is not None:
+                self._bytes -= len(value)
+                return True
+            if (ns, key) in self._spilled:
+                self._spilled.discard((ns, key))
+                self._spill.delete(ns, key)
+                return True
+            return False
+
+    def keys(self, ns: str) -> List[str]:
+        with self._lock:
+            found = {key for item_ns, key in self._items if item_ns == ns}
+            found.update(key for item_ns, key in self._spilled if item_ns == ns)
+            return sorted(found)
+
+    def count(self, ns: str) -> int:
+        with self._lock:
+            # A key lives either in memory or in the spill file, never both
+            return sum(1 for item_ns, _ in self._items if item_ns == ns) + sum(
+                1 for item_ns, _ in self._spilled if item_ns == ns
+            )
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            spilled = self._spill.size_bytes() if self._spill is not None else 0
+            return self._bytes + spilled
+
+    def close(self) -> None:
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+
+
+class DocumentStore:
+    # Router-facing interface. Extracted text is stored once per content hash in
+    # "blobs" (refcounted). Each UUID has a manifest in "meta": an ordered list of
+    # segments (one per uploaded PDF), each with its own ID, blob reference, size and
+    # token count, plus a digest that identifies the document content. Appending,
+    # replacing or removing a segment only touches that segment's blob.
+    # Ingest-time artifacts live next to the data they describe: page offsets and the
+    # outline per blob in "blob_artifacts", the optional summary per digest in "summaries".
+
+    SEPARATOR = "\n\n"
+
+    def __init__(self, backend: StoreBackend):
+        self.backend = backend
+
+    def __contains__(self, uuid: str) -> bool:
+        return self.backend.get("meta", uuid) is not None
+
+    def __len__(self) -> int:
+        return self.backend.count("meta")
+
+    def keys(self) -> List[str]:
+        return self.backend.keys("meta")
+
+    def _meta(self, uuid: str) -> Optional[dict]:
+        raw = self.backend.get("meta", uuid)
+        return json.loads(raw) if raw is not None else None
+
+    def _incref(self, ns: str, key: str, delta: int) -> int:
+        # Caller must hold a transaction
+        raw = self.backend.get(ns, key)
+        count = (int(raw) if raw is not None else 0) + delta
+        if count > 0:
+            self.backend.put(ns, key, str(count).encode("ascii"))
+        else:
+            self.backend.delete(ns, key)
+        return count
+
+    def _store_blob(self, text: Optional[str], source_hash: Optional[str], artifacts: Optional[dict] = None) -> dict:
+        # Caller must hold a transaction. Reuses an existing blob when the source was seen
+        # before and returns a new segment referencing it.
+        if source_hash is None:
+            if text is None:
+                raise ValueError("Either text or source_hash is required")
+            source_hash = "text-" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+        existing = self.backend.get("blob_info", source_hash)
+        if existing is not None:
+            blob_info = json.loads(existing)
+        elif text is None:
+            raise KeyError(f"No stored blob for {source_hash}")
+        else:
+            data = text.encode("utf-8")
+            blob_info = {"size": len(data), "tokens": count_tokens(text), "pages": len((artifacts or {}).get("pages") or [0])}
+            self.backend.put("blobs", source_hash, data)
+            self.backend.put("blob_info", source_hash, json.dumps(blob_info).encode("utf-8"))
+            if artifacts:
+                self.backend.put("blob_artifacts", source_hash, json.dumps(artifacts).encode("utf-8"))
+        self._incref("blob_refs", source_hash, 1)
+        return {"id": uuid_pkg.uuid4().hex[:12], "blob": source_hash, **blob_info}
+
+    def _release_blob(self, blob: str) -> None:
+        # Caller must hold a transaction
+        if self._incref("blob_refs", blob, -1) <= 0:
+            self.backend.delete("blobs", blob)
+            self.backend.delete("blob_info", blob)
+            self.backend.delete("blob_artifacts", blob)
+
+    def _release_digest(self, digest: str) -> None:
+        # Caller must hold a transaction. The summary goes with the last document using the digest.
+        if self._incref("digest_refs", digest, -1) <= 0:
+            self.backend.delete("summaries", digest)
+
+    def _write_meta(self, uuid: str, segments: List[dict], previous: Optional[dict]) -> None:
+        # Caller must hold a transaction. The digest covers the ordered blob list, so
+        # UUIDs built from the same PDFs share one digest (and its caches).
+        digest = hashlib.sha256("\n".join(segment["blob"] for segment in segments).encode("utf-8")).hexdigest()
+        self._incref("digest_refs", digest, 1)
+        if previous is not None:
+            self._release_digest(previous["digest"])
+        meta = {
+            "digest": digest,
+            "size": sum(segment["size"] for segment in segments) + len(self.SEPARATOR) * max(0, len(segments) - 1),
+            "tokens": sum(segment["tokens"] for segment in segments),
+            "segments": segments,
+        }
+        self.backend.put("meta", uuid, json.dumps(meta).encode("utf-8"))
+
+    def has_blob(self, source_hash: str) -> bool:
+        return self.backend.get("blob_info", source_hash) is not None
+
+    def blob_text(self, blob: str) -> Optional[str]:
+        with stage_seconds.time(stage="store_read"):
+            data = self.backend.get("blobs", blob)
+        return data.decode("utf-8") if data is not None else None
+
+    def digest_in_use(self, digest: str) -> bool:
+        return self.backend.get("digest_refs", digest) is not None
+
+    def blob_artifacts(self, blob: str) -> dict:
+        # Blobs stored without artifacts (plain text, older stores) count as one page
+        raw = self.backend.get("blob_artifacts", blob)
+        return json.loads(raw) if raw is not None else {"pages": [0], "outline": []}
+
+    def summary(self, digest: str) -> Optional[dict]:
+        raw = self.backend.get("summaries", digest)
+        return json.loads(raw) if raw is not None else None
+
+    def set_summary(self, digest: str, summary: dict) -> bool:
+        # Not stored when every document with this digest was changed or deleted meanwhile
+        with self.backend.transaction():
+            if not self.digest_in_use(digest):
+                return False
+            self.backend.put("summaries", digest, json.dumps(summary).encode("utf-8"))
+            return True
+
+    def get(self, uuid: str) -> Optional[str]:
+        meta = self._meta(uuid)
+        if meta is None:
+            return None
+        parts = []
+        with stage_seconds.time(stage="store_read"):
+            for segment in meta["segments"]:
+                data = self.backend.get("blobs", segment["blob"])
+                if data is not None:
+                    parts.append(data.decode("utf-8"))
+        return self.SEPARATOR.join(parts)
+
+    def info(self, uuid: str) -> Optional[dict]:
+        # Digest, size, token count and segment list without loading the text
+        return self._meta(uuid)
+
+    def digest(self, uuid: str) -> Optional[str]:
+        meta = self._meta(uuid)
+        return meta["digest"] if meta else None
+
+    def segments(self, uuid: str) -> Optional[List[dict]]:
+        meta = self._meta(uuid)
+        return meta["segments"] if meta else None
+
+    def add(self, uuid: str, text: Optional[str] = None, source_hash: Optional[str] = None,
+            artifacts: Optional[dict] = None) -> Optional[str]:
+        # Returns the new segment ID, or None instead of overwriting, so two workers cannot
+        # both create the same UUID. With only source_hash, links an already stored blob
+        # (KeyError if it is gone).
+        with self.backend.transaction():
+            if uuid in self:
+                return None
+            segment = self._store_blob(text, source_hash, artifacts)
+            self._write_meta(uuid, [segment], None)
+            return segment["id"]
+
+    def append(self, uuid: str, text: Optional[str] = None, source_hash: Optional[str] = None,
+               artifacts: Optional[dict] = None) -> Optional[str]:
+        # O(new data): only the new segment is written, existing blobs are untouched
+        with self.backend.transaction():
+            previous = self._meta(uuid)
+            if previous is None:
+                return None
+            segment = self._store_blob(text, source_hash, artifacts)
+            self._write_meta(uuid, previous["segments"] + [segment], previous)
+            return segment["id"]
+
+    def replace_segment(self, uuid: str, segment_id: str, text: Optional[str] = None,
+                        source_hash: Optional[str] = None, artifacts: Optional[dict] = None) -> Optional[str]:
+        with self.backend.transaction():
+            previous = self._meta(uuid)
+            if previous is None:
+                return None
+            segments = list(previous["segments"])
+            for position, segment in enumerate(segments):
+                if segment["id"] == segment_id:
+                    break
+            else:
+                return None
+            replacement = self._store_blob(text, source_hash, artifacts)
+            replacement["id"] = segment_id
+            self._release_blob(segments[position]["blob"])
+            segments[position] = replacement
+            self._write_meta(uuid, segments, previous)
+            return segment_id
+
+    def remove_segment(self, uuid: str, segment_id: str) -> bool:
+        with self.backend.transaction():
+            previous = self._meta(uuid)
+            if previous is None:
+                return False
+            segments = [segment for segment in previous["segments"] if segment["id"] != segment_id]
+            if len(segments) == len(previous["segments"]):
+                return False
+            if not segments:
+                raise ValueError("Cannot remove the only segment of a document, delete the document instead")
+            self._release_blob(next(s["blob"] for s in previous["segments"] if s["id"] == segment_id))
+            self._write_meta(uuid, segments, previous)
+            return True
+
+    def delete(self, uuid: str) -> bool:
+        with self.backend.transaction():
+            previous = self._meta(uuid)
+            if previous is None:
+                return False
+            for segment in previous["segments"]:
+                self._release_blob(segment["blob"])
+            self._release_digest(previous["digest"])
+            return self.backend.delete("meta", uuid)
+
+    def close(self) -> None:
+        self.backend.close()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend.name,
+            "documents": len(self),
+            "blobs": self.backend.count("blob_info"),
+            "bytes": self.backend.size_bytes(),
+        }
+
+
+def create_backend(name: str = STORE_BACKEND) -> StoreBackend:
+    if name == "sqlite":
+        return SQLiteBackend(STORE_PATH)
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown CAG_STORE_BACKEND '{name}', expected 'memory' or 'sqlite'")
+
+
+data_store = DocumentStore(create_backend())
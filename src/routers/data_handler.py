@@ -1,6 +1,15 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Query 
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from typing import Annotated, Callable, List, Literal, Optional, Tuple, Union
 import uuid as uuid_pkg
+import asyncio
+import functools
+import json
 import os
+import re
+import time
 import logging 
 
 router = APIRouter()
@@ -15,12 +24,53 @@ from src.data_store import data_store
 
 # PDF processing utility
 
-from src.utils.pdf_processor import extract_text_from_pdf
+from src.utils.pdf_processor import extract_document_from_pdf
+
+# Page map, outline and summary built at ingest
+
+from src.utils.artifacts import (
+    DOCUMENT_SUMMARY, SUMMARY_CONTEXT_TOKENS, SUMMARY_PROMPT, PAGE_CITATION_INSTRUCTIONS,
+    page_slices, page_at, parse_page_range, cited_pages, is_overview_question,
+)
 
 # LLM client Utility
 
-from src.utils.llm_client import get_llm_responce
+from src.utils.llm_client import (
+    get_llm_responce, get_llm_batch_responce, stream_llm_responce, warm_document_cache, KV_WARMUP_ENABLED, SYSTEM_INSTRUCTIONS,
+    BATCH_PACK_MAX_TOKENS, llm_router,
+)
+from src.utils.llm_backends import Backend, UpstreamUnavailable, BREAKER_RESET
+
+# Answer cache in front of the LLM
+
+from src.utils.answer_cache import answer_cache, content_hash
+from src.utils.prompt_cache import prompt_cache_stats
+
+# Identical concurrent questions share one upstream call
+
+from src.utils.singleflight import llm_calls
+
+# Per-stage latency metrics
+
+from src.utils.metrics import stage_seconds
+
+# Chunked retrieval for large documents
+
+from src.utils.retrieval import (
+    retrieval_indexes, FULL_CONTEXT_MAX_TOKENS, RETRIEVAL_TOKEN_BUDGET, RETRIEVAL_TOP_K, RETRIEVAL_CHUNK_TOKENS
+)
+
+# Token budgeting against the model's context window
+
+from src.utils.tokens import context_budget, count_tokens
 
+# Background ingestion queue
+
+from src.utils.ingest import ingest_queue, IngestJob, IngestQueueFull
+
+# Uploads are parsed as they arrive and written to disk once
+
+from src.utils.uploads import UploadReceiver, UploadTooLarge, InvalidUpload, UnsupportedFileType, MAX_UPLOAD_BYTES
 
 
 # Define temporary directory for uploads
@@ -28,112 +78,1038 @@ from src.utils.llm_client import get_llm_responce
 UPLOAD_DIR = "/tmp/cag_uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-@router.post("/upload/{uuid}", status_code=201) 
-def upload_pdf(uuid: uuid_pkg.UUID, file: UploadFile = File(...)):
-    if file.content_type != "application/pdf":
-        raise HTTPException(
-            status_code=400, detail="Invalid File type.Only PDF Files are allowed"
-        )
-    uuid_str = str(uuid)
-    if uuid_str in data_store:
-        raise HTTPException(
-            status_code=400,
-            detail=f"UUID {uuid_str} already Exist ,Use PUT api/V1/update/{uuid_str} to modify"
-        )
+# Uploaded PDFs come in a multipart/form-data body with one file field; documented
+# by hand since the endpoints read the body themselves
 
-    file_path = os.path.join(UPLOAD_DIR, f"{uuid_str}_{file.filename}")
+PDF_UPLOAD_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                },
+            },
+        },
+    },
+}
 
-    try:
-        # Save the uploaded file temporarily
+# Batch queries: questions per request and LLM calls in flight per batch
 
-        with open(file_path, "wb") as buffer:
-            buffer.write(file.file.read())
+BATCH_MAX_QUESTIONS = int(os.environ.get("CAG_BATCH_MAX_QUESTIONS", "50"))
+BATCH_CONCURRENCY = int(os.environ.get("CAG_BATCH_CONCURRENCY", "4"))
 
-        # Extract Text using the utility function
-        
-        extracted_text = extract_text_from_pdf(file_path)
-        if extracted_text is None:
+# Cross-document queries: documents per query, LLM calls in flight and deadline for the map step
+
+MULTI_QUERY_MAX_DOCUMENTS = int(os.environ.get("CAG_MULTI_QUERY_MAX_DOCUMENTS", "100"))
+MULTI_QUERY_CONCURRENCY = int(os.environ.get("CAG_MULTI_QUERY_CONCURRENCY", "8"))
+MULTI_QUERY_TIMEOUT = float(os.environ.get("CAG_MULTI_QUERY_TIMEOUT", "120"))
+
+def _remove_file(file_path: str) -> None:
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+def _upload_path(uuid_str: str, kind: str) -> str:
+    # Unique per request so concurrent requests for one UUID never share a temp file
+    return os.path.join(UPLOAD_DIR, f"{uuid_str}_{kind}_{uuid_pkg.uuid4().hex}.pdf")
+
+def _schedule_warmup(loop: asyncio.AbstractEventLoop, uuid_str: str, digest: str, text: str) -> None:
+    # Precompute the document's KV cache on a local server
+    if KV_WARMUP_ENABLED:
+        asyncio.run_coroutine_threadsafe(warm_document_cache(uuid_str, digest, text), loop)
+
+def _extract_or_reuse(job: IngestJob, file_path: str, store_text) -> None:
+    # Content-addressed: a PDF whose hash is already stored is linked, not extracted again.
+    # store_text(text, artifacts) stores a new segment (text=None links the known blob) and returns its ID.
+    if job.sha256 and data_store.has_blob(job.sha256):
+        try:
+            job.segment_id = store_text(None)
+            job.deduplicated = True
+            return
+        except KeyError:
+            pass  # The blob was released in the meantime; extract as usual
+    extracted_text, artifacts = extract_document_from_pdf(file_path, progress=job.progress)
+    if extracted_text is None:
+        raise ValueError("Failed to extract text from PDF.")
+    job.segment_id = store_text(extracted_text, artifacts)
+
+def _segment_blobs(info: dict) -> list:
+    return [segment["blob"] for segment in info["segments"]]
+
+def _document_pages(info: dict) -> List[Tuple[dict, int, dict]]:
+    # (segment, number of its first page, blob artifacts) per segment. Pages are numbered
+    # from 1 across the whole document, in segment order.
+    pages = []
+    first_page = 1
+    for segment in info["segments"]:
+        artifacts = data_store.blob_artifacts(segment["blob"])
+        pages.append((segment, first_page, artifacts))
+        first_page += len(artifacts["pages"])
+    return pages
+
+def _page_count(info: dict) -> int:
+    return sum(segment.get("pages", 1) for segment in info["segments"])
+
+def _marked_page_parts(uuid_str: str, info: dict, first: int = 1, last: int = None) -> Tuple[List[str], int]:
+    # Pages first..last, each introduced by [Page N] so answers can cite it, and their token
+    # estimate: each page's share of its segment's ingest-time count, plus the markers
+    parts = []
+    tokens = 0
+    for segment, first_page, artifacts in _document_pages(info):
+        offsets = artifacts["pages"]
+        last_page = first_page + len(offsets) - 1
+        if last_page < first or (last is not None and first_page > last):
+            continue
+        text = data_store.blob_text(segment["blob"])
+        if text is None:
             raise HTTPException(
-                status_code=500, detail="Failed to extract text from PDF."
+                status_code=404, detail=f"UUID {uuid_str} not found ."
             )
+        pages = page_slices(text, offsets)
+        for number in range(max(first, first_page), min(last or last_page, last_page) + 1):
+            page = pages[number - first_page]
+            if page:
+                marker = f"[Page {number}]\n"
+                parts.append(marker + page)
+                tokens += count_tokens(marker) + round(segment["tokens"] * len(page) / max(1, len(text)))
+    return parts, tokens
+
+def _marked_pages(uuid_str: str, info: dict, first: int = 1, last: int = None) -> str:
+    return "\n".join(_marked_page_parts(uuid_str, info, first, last)[0])
+
+def _page_range_context(uuid_str: str, info: dict, first: int, last: int) -> Tuple[str, str, int]:
+    # Text, content hash and token estimate of a page range, all computed off the event loop
+    parts, tokens = _marked_page_parts(uuid_str, info, first, last)
+    text = "\n".join(parts)
+    return text, content_hash(text), tokens
+
+def _page_labeler(info: dict) -> Callable[[str, int], str]:
+    # Labels a retrieved chunk with the page it starts on
+    first_pages = {}
+    for segment, first_page, artifacts in _document_pages(info):
+        first_pages.setdefault(segment["blob"], (first_page, artifacts["pages"]))
+
+    def label(blob: str, offset: int) -> str:
+        first_page, offsets = first_pages[blob]
+        return f"[Page {first_page + page_at(offsets, offset)}]"
+
+    return label
+
+# Digests with a summary being generated in this process
+_summaries_pending = set()
+
+def _schedule_summary(loop: asyncio.AbstractEventLoop, uuid_str: str, digest: str) -> None:
+    # One background summary per document content, shared by identical documents
+    if digest in _summaries_pending or data_store.summary(digest) is not None:
+        return
+    _summaries_pending.add(digest)
+    asyncio.run_coroutine_threadsafe(_generate_summary(uuid_str, digest), loop)
+
+def _summary_context(uuid_str: str, info: dict) -> Tuple[str, int]:
+    # The outline plus the whole text, or only its start when the document is long
+    if info["tokens"] <= SUMMARY_CONTEXT_TOKENS:
+        text, tokens = _load_full_text(uuid_str), info["tokens"]
+    else:
+        selection = retrieval_indexes.select_context(
+            uuid_str, _segment_blobs(info), data_store.blob_text, "", SUMMARY_CONTEXT_TOKENS
+        )
+        if selection is None:
+            raise ValueError(f"UUID {uuid_str} changed while it was being summarized")
+        text, _, tokens = selection
+    outline = [
+        f"{'  ' * (entry['level'] - 1)}{entry['title']} (p. {first_page + entry['page']})"
+        for _, first_page, artifacts in _document_pages(info) for entry in artifacts.get("outline", [])
+    ]
+    if outline:
+        text = "OUTLINE:\n" + "\n".join(outline) + "\n\nTEXT:\n" + text
+    return text, tokens
+
+async def _generate_summary(uuid_str: str, digest: str) -> None:
+    try:
+        info = await run_in_threadpool(data_store.info, uuid_str)
+        if info is None or info["digest"] != digest:
+            return  # Changed again meanwhile; the new version schedules its own summary
+        context, tokens = await run_in_threadpool(_summary_context, uuid_str, info)
+        summary = await get_llm_responce(context=context, query=SUMMARY_PROMPT, context_tokens=tokens)
+        await run_in_threadpool(data_store.set_summary, digest, {
+            "text": summary,
+            "model": _llm_backend(tokens).model,
+            "tokens_sent": tokens,
+            "created_at": time.time(),
+        })
+        logging.info(f"Stored summary for UUID {uuid_str}")
+    except Exception as e:
+        logging.error(f"Summary generation failed for UUID {uuid_str}: {e}")
+    finally:
+        _summaries_pending.discard(digest)
+
+def _after_ingest(uuid_str: str, loop: asyncio.AbstractEventLoop, previous_digest: str = None) -> None:
+    info = data_store.info(uuid_str)
+    if info is None:
+        return
+    digest = info["digest"]
+    if previous_digest and previous_digest != digest and not data_store.digest_in_use(previous_digest):
+        # Answers on the old full text are dropped; answers on chunks or pages that may
+        # still be selected now belong to the new version
+        answer_cache.transfer(previous_digest, digest)
+    # Only segments that were not indexed before are chunked and indexed
+    retrieval_indexes.sync(uuid_str, _segment_blobs(info), data_store.blob_text)
+    if KV_WARMUP_ENABLED:
+        _schedule_warmup(loop, uuid_str, digest, data_store.get(uuid_str))
+    if DOCUMENT_SUMMARY:
+        _schedule_summary(loop, uuid_str, digest)
+
+def _ingest_upload(job: IngestJob, file_path: str, loop: asyncio.AbstractEventLoop) -> None:
+    def store_text(extracted_text: str, artifacts: dict = None) -> str:
         # Store the Extracted Text
-        data_store[uuid_str] = extracted_text
-        return {
-            "message": "File uploaded and text extracted successfully",
-            "uuid": uuid_str
-        }
+        segment_id = data_store.add(job.uuid, extracted_text, source_hash=job.sha256, artifacts=artifacts)
+        if segment_id is None:
+            raise ValueError(f"UUID {job.uuid} already Exist ,Use PUT api/V1/update/{job.uuid} to modify")
+        return segment_id
+
+    try:
+        _extract_or_reuse(job, file_path, store_text)
+        _after_ingest(job.uuid, loop)
+    finally:
+        # Clean up the temporary file
+        _remove_file(file_path)
+
+def _ingest_update(job: IngestJob, file_path: str, loop: asyncio.AbstractEventLoop) -> None:
+    previous_digest = data_store.digest(job.uuid)
+
+    def store_text(new_text: str, artifacts: dict = None) -> str:
+        # Appends a new segment; existing segments are untouched
+        segment_id = data_store.append(job.uuid, new_text, source_hash=job.sha256, artifacts=artifacts)
+        if segment_id is None:
+            raise ValueError(f"UUID {job.uuid} not found,Use POST /api/V1/upload/... ")
+        return segment_id
+
+    try:
+        _extract_or_reuse(job, file_path, store_text)
+        _after_ingest(job.uuid, loop, previous_digest)
+    finally:
+        # Clean up the temporary file
+        _remove_file(file_path)
+
+def _ingest_replace_segment(job: IngestJob, file_path: str, loop: asyncio.AbstractEventLoop, segment_id: str) -> None:
+    previous_digest = data_store.digest(job.uuid)
+
+    def store_text(new_text: str, artifacts: dict = None) -> str:
+        if data_store.replace_segment(job.uuid, segment_id, new_text, source_hash=job.sha256, artifacts=artifacts) is None:
+            raise ValueError(f"Segment {segment_id} of UUID {job.uuid} not found .")
+        return segment_id
+
+    try:
+        _extract_or_reuse(job, file_path, store_text)
+        _after_ingest(job.uuid, loop, previous_digest)
+    finally:
+        # Clean up the temporary file
+        _remove_file(file_path)
+
+async def _queue_ingestion(uuid_str: str, kind: str, request: Request, work, invalid_type: str) -> IngestJob:
+    file_path = _upload_path(uuid_str, kind)
+    receiver = UploadReceiver(file_path, content_type="application/pdf", max_bytes=MAX_UPLOAD_BYTES)
+    try:
+        # Save the uploaded file temporarily, straight from the request body
+        with stage_seconds.time(stage="upload_write"):
+            await receiver.receive(request.headers, request.stream())
+        size, sha256 = receiver.size, receiver.sha256
+    except UploadTooLarge as e:
+        _remove_file(file_path)
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedFileType:
+        _remove_file(file_path)
+        raise HTTPException(status_code=400, detail=invalid_type)
+    except InvalidUpload as e:
+        _remove_file(file_path)
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
-        logging.error(f"Error during PDF upload and processing for UUID {uuid_str}: {e}", exc_info=True) # Log the exception
+        logging.error(f"Error while saving PDF {kind} for UUID {uuid_str}: {e}", exc_info=True) # Log the exception
+        _remove_file(file_path)
         raise HTTPException(
             status_code=500,
             detail=f"An error occurred during file Processing {str(e)}",
         )
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    loop = asyncio.get_running_loop()
+    try:
+        return ingest_queue.submit(
+            uuid_str, kind, size, lambda job: work(job, file_path, loop), sha256=sha256
+        )
+    except IngestQueueFull as e:
+        _remove_file(file_path)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except ValueError as e:
+        _remove_file(file_path)
+        raise HTTPException(status_code=409, detail=str(e))
+
+def _job_accepted(message: str, job: IngestJob) -> dict:
+    return {
+        "message": message,
+        "uuid": job.uuid,
+        "job_id": job.job_id,
+        "status_url": f"/api/v1/jobs/{job.job_id}",
+    }
 
-@router.put("/update/{uuid}")
-def update_pdf_data(uuid: uuid_pkg.UUID, file: UploadFile = File(...)):
-    if file.content_type != "application/pdf":
+@router.post("/upload/{uuid}", status_code=202, openapi_extra=PDF_UPLOAD_BODY) 
+async def upload_pdf(uuid: uuid_pkg.UUID, request: Request):
+    uuid_str = str(uuid)
+    if await run_in_threadpool(data_store.__contains__, uuid_str) or ingest_queue.active_job(uuid_str):
         raise HTTPException(
-            status_code=400, detail="Invalid file type,Only pdfs files are Allowed"
+            status_code=400,
+            detail=f"UUID {uuid_str} already Exist ,Use PUT api/V1/update/{uuid_str} to modify"
         )
+    job = await _queue_ingestion(
+        uuid_str, "upload", request, _ingest_upload, "Invalid File type.Only PDF Files are allowed"
+    )
+    return _job_accepted("File uploaded, text extraction queued", job)
+
+@router.put("/update/{uuid}", status_code=202, openapi_extra=PDF_UPLOAD_BODY)
+async def update_pdf_data(uuid: uuid_pkg.UUID, request: Request):
     uuid_str = str(uuid)
-    if uuid_str not in data_store:
+    if not await run_in_threadpool(data_store.__contains__, uuid_str) and not ingest_queue.active_job(uuid_str):
         raise HTTPException(
             status_code=404,
             detail=f"UUID {uuid_str} not found,Use POST /api/V1/upload/... "
         )
-    file_path = os.path.join(UPLOAD_DIR, f"{uuid_str}_update_{file.filename}")
+    job = await _queue_ingestion(
+        uuid_str, "update", request, _ingest_update, "Invalid file type,Only pdfs files are Allowed"
+    )
+    return _job_accepted(f"Update for UUID {uuid_str} queued", job)
+
+@router.get("/documents/{uuid}/segments")
+def list_segments(uuid: uuid_pkg.UUID):
+    uuid_str = str(uuid)
+    info = data_store.info(uuid_str)
+    if info is None:
+        raise HTTPException(
+            status_code=404, detail=f"UUID {uuid_str} not found ."
+        )
+    return {
+        "uuid": uuid_str,
+        "digest": info["digest"],
+        "tokens": info["tokens"],
+        "segments": [
+            {
+                "segment_id": segment["id"], "size": segment["size"], "tokens": segment["tokens"],
+                "pages": segment.get("pages", 1), "blob": segment["blob"],
+            }
+            for segment in info["segments"]
+        ],
+    }
+
+@router.put("/update/{uuid}/segments/{segment_id}", status_code=202, openapi_extra=PDF_UPLOAD_BODY)
+async def replace_segment(uuid: uuid_pkg.UUID, segment_id: str, request: Request):
+    uuid_str = str(uuid)
+    segments = await run_in_threadpool(data_store.segments, uuid_str)
+    if segments is None or not any(segment["id"] == segment_id for segment in segments):
+        raise HTTPException(
+            status_code=404, detail=f"Segment {segment_id} of UUID {uuid_str} not found ."
+        )
+    job = await _queue_ingestion(
+        uuid_str, "replace_segment", request, functools.partial(_ingest_replace_segment, segment_id=segment_id),
+        "Invalid file type,Only pdfs files are Allowed",
+    )
+    return _job_accepted(f"Replacement of segment {segment_id} queued", job)
+
+@router.delete("/data/{uuid}/segments/{segment_id}")
+async def remove_segment(uuid: uuid_pkg.UUID, segment_id: str):
+    uuid_str = str(uuid)
+    if ingest_queue.active_job(uuid_str):
+        raise HTTPException(
+            status_code=409, detail=f"UUID {uuid_str} is still being ingested, retry when the job is done"
+        )
+    previous_digest = await run_in_threadpool(data_store.digest, uuid_str)
     try:
-        # Save the uploaded file temporarily
-        with open(file_path, "wb") as buffer:
-            buffer.write(file.file.read())
-        # Extract Text from the new PDF
-        new_text = extract_text_from_pdf(file_path)
-        if new_text is None:
+        removed = await run_in_threadpool(data_store.remove_segment, uuid_str, segment_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not removed:
+        raise HTTPException(
+            status_code=404, detail=f"Segment {segment_id} of UUID {uuid_str} not found ."
+        )
+    await run_in_threadpool(_after_ingest, uuid_str, asyncio.get_running_loop(), previous_digest)
+    return {"message": f"Segment {segment_id} of UUID {uuid_str} removed successfully"}
+
+@router.get("/jobs/{job_id}")
+def get_ingest_job(job_id: str):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found .")
+    return job.to_dict()
+
+@router.get("/jobs")
+def ingest_queue_stats():
+    return ingest_queue.stats()
+
+def _still_ingesting(job: IngestJob) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={
+            "uuid": job.uuid,
+            "status": "ingesting",
+            "detail": f"UUID {job.uuid} is still being ingested, retry when the job is done",
+            "job": job.to_dict(),
+        },
+        headers={"Retry-After": "2"},
+    )
+
+class PreparedQuery:
+    # Everything needed to answer one question: the context to send, the cache key and
+    # the token accounting reported back to the client
+    def __init__(self, query: str, mode: str, digest: str):
+        self.query = query
+        self.mode = mode
+        # Digest of the document answered from; every cached answer is indexed under it
+        # so deleting or updating the document drops it
+        self.digest = digest
+        self.stored_text = None
+        # Full-mode answers are tied to the whole document; retrieval answers only to the
+        # chunks actually sent, so they survive appends that do not change the selection
+        self.cache_tag = digest
+        self.cache_key = None
+        self.context_tokens = None
+        self.context_info = None
+        # Page-marked context; the answer is asked to cite pages
+        self.cite_pages = False
+        self.page_count = None
+
+    @property
+    def prompt(self) -> str:
+        return self.query + PAGE_CITATION_INSTRUCTIONS if self.cite_pages else self.query
+
+    @property
+    def prefix_digest(self):
+        # Retrieved context differs per question, so only full mode has a stable prefix to cache
+        return self.cache_tag if self.mode == "full" else None
+
+def _lookup_document(uuid_str: str):
+    # Returns the document info, or a 202 response while the first upload is still ingesting
+    info = data_store.info(uuid_str)
+    if info is None:
+        job = ingest_queue.active_job(uuid_str)
+        if job is not None:
+            return None, _still_ingesting(job)
+        raise HTTPException(
+            status_code=404, detail=f"UUID {uuid_str} not found ."
+        )
+    return info, None
+
+def _llm_backend(context_tokens: int) -> Backend:
+    # The backend expected to answer a context of this size; its model and sampling
+    # parameters go into the answer cache key
+    route = llm_router.route_for(context_tokens)
+    candidates = route.candidates(context_tokens)
+    return candidates[0] if candidates else route.primary
+
+def _llm_budget(document_tokens: int, *prompt_parts: str, max_tokens: int = None) -> int:
+    # Room for the document on the route a document of this size is sent to
+    route = llm_router.route_for(document_tokens)
+    backend = max(route.backends, key=lambda backend: backend.context_limit)
+    return context_budget(backend.context_limit, max_tokens or backend.max_tokens, *prompt_parts)
+
+async def _prepare_query(uuid_str: str, info: dict, query: str, mode: str,
+                         page_range: Tuple[int, int] = None, cite_pages: bool = False) -> PreparedQuery:
+    # Context selection and budgeting, timed as the prompt_build stage
+    with stage_seconds.time(stage="prompt_build"):
+        if page_range is not None:
+            return await _select_pages(uuid_str, info, query, page_range)
+        return await _select_context(uuid_str, info, query, mode, cite_pages)
+
+async def _select_pages(uuid_str: str, info: dict, query: str, page_range: Tuple[int, int]) -> PreparedQuery:
+    # Only the requested pages, always page-marked; answers are tied to exactly that text
+    prepared = PreparedQuery(query, "pages", info["digest"])
+    prepared.cite_pages = True
+    prepared.page_count = _page_count(info)
+    prepared.stored_text, prepared.cache_tag, tokens_sent = await run_in_threadpool(
+        _page_range_context, uuid_str, info, *page_range
+    )
+    budget = _llm_budget(tokens_sent, SYSTEM_INSTRUCTIONS, prepared.prompt)
+    if tokens_sent > budget:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Pages {page_range[0]}-{page_range[1]} are {tokens_sent} tokens, more than the {budget} that fit the model; ask for fewer pages",
+        )
+    backend = _llm_backend(tokens_sent)
+    prepared.context_tokens = tokens_sent
+    prepared.cache_key = answer_cache.make_key(
+        prepared.cache_tag, query, backend.model, backend.temperature, backend.max_tokens, context_mode="pages"
+    )
+    prepared.context_info = {
+        "mode": "pages",
+        "pages": list(page_range),
+        "tokens_sent": tokens_sent,
+        "tokens_full": info["tokens"],
+        "context_trimmed": False,
+    }
+    return prepared
+
+async def _select_context(uuid_str: str, info: dict, query: str, mode: str, cite_pages: bool = False) -> PreparedQuery:
+    if mode == "auto":
+        mode = "retrieval" if info["tokens"] > FULL_CONTEXT_MAX_TOKENS else "full"
+    budget = _llm_budget(info["tokens"], SYSTEM_INSTRUCTIONS, query)
+    context_trimmed = mode == "full" and info["tokens"] > budget
+    prepared = PreparedQuery(query, mode, info["digest"])
+    prepared.cite_pages = cite_pages
+    prepared.page_count = _page_count(info)
+    tokens_sent = info["tokens"]
+    if mode == "retrieval" or context_trimmed:
+        if context_trimmed:
+            # The whole document does not fit the model; send as many of the best chunks as do
+            selection_args = (budget, max(RETRIEVAL_TOP_K, budget // RETRIEVAL_CHUNK_TOKENS))
+            prepared.mode = "retrieval"
+        else:
+            selection_args = (min(RETRIEVAL_TOKEN_BUDGET, budget), RETRIEVAL_TOP_K)
+        chunk_label = await run_in_threadpool(_page_labeler, info) if cite_pages else None
+        selection = await run_in_threadpool(
+            retrieval_indexes.select_context, uuid_str, _segment_blobs(info), data_store.blob_text, query, *selection_args,
+            chunk_label=chunk_label,
+        )
+        if selection is None:
             raise HTTPException(
-                status_code=500, detail="Failed to extract text from PDF."
+                status_code=404, detail=f"UUID {uuid_str} not found ."
             )
-        
-        data_store[uuid_str] += "\n\n" + new_text
-        return {
-            "message": f"Data for UUID {uuid_str} updated successfully",
-            "uuid": uuid_str
-        }
-    except Exception as e:
-        logging.error(f"Error during PDF update and processing for UUID {uuid_str}: {e}", exc_info=True) # Log the exception
+        prepared.stored_text, prepared.cache_tag, tokens_sent = selection
+    backend = _llm_backend(tokens_sent)
+    prepared.context_tokens = tokens_sent
+    prepared.cache_key = answer_cache.make_key(
+        prepared.cache_tag, query, backend.model, backend.temperature, backend.max_tokens,
+        context_mode=f"{prepared.mode}-cited" if cite_pages else prepared.mode,
+    )
+    prepared.context_info = {
+        "mode": prepared.mode,
+        "tokens_sent": tokens_sent,
+        "tokens_full": info["tokens"],
+        "context_trimmed": context_trimmed,
+    }
+    return prepared
+
+def _load_full_text(uuid_str: str) -> str:
+    stored_text = data_store.get(uuid_str)
+    if stored_text is None:
         raise HTTPException(
-            status_code=500,
-            detail=f"An error occurred during file Processing {str(e)}",
+            status_code=404, detail=f"UUID {uuid_str} not found ."
         )
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    return stored_text
+
+async def _answer(uuid_str: str, prepared: PreparedQuery) -> Tuple[str, bool]:
+    # One upstream call per cache key at a time; returns the answer and whether it was coalesced
+    async def call() -> str:
+        llm_responce = await get_llm_responce(
+            context=prepared.stored_text, query=prepared.prompt, uuid=uuid_str, digest=prepared.prefix_digest,
+            context_tokens=prepared.context_tokens,
+        )
+        answer_cache.set(prepared.cache_key, llm_responce, prepared.cache_tag, prepared.digest)
+        return llm_responce
+
+    return await llm_calls.do(prepared.cache_key, call)
 
 @router.get("/query/{uuid}")
-def query_data(uuid: uuid_pkg.UUID, query: str = Query(..., min_length=1)):
+async def query_data(
+    uuid: uuid_pkg.UUID,
+    query: str = Query(..., min_length=1),
+    stream: bool = Query(False, description="Stream the answer as Server-Sent Events"),
+    mode: Literal["auto", "full", "retrieval"] = Query(
+        "auto", description="Send the whole document, only the most relevant chunks, or decide by size"
+    ),
+    pages: Optional[str] = Query(None, description="Only use these pages, e.g. 4 or 4-9"),
+    cite_pages: bool = Query(False, description="Mark pages in the context and cite them in the answer"),
+):
+    uuid_str = str(uuid)
+    info, pending = await run_in_threadpool(_lookup_document, uuid_str)
+    if pending is not None:
+        return pending
+    page_range = None
+    if pages is not None:
+        try:
+            page_range = parse_page_range(pages, _page_count(info))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif mode == "auto" and is_overview_question(query):
+        summary = await run_in_threadpool(data_store.summary, info["digest"])
+        if summary is not None:
+            return _summary_answer(uuid_str, query, info, summary, stream)
+    prepared = await _prepare_query(uuid_str, info, query, mode, page_range, cite_pages)
+    llm_responce = answer_cache.get(prepared.cache_key)
+    cached = llm_responce is not None
+    if not cached and prepared.stored_text is None:
+        # Reading and decompressing a large document takes milliseconds; keep it off the event loop
+        if prepared.cite_pages:
+            prepared.stored_text = await run_in_threadpool(_marked_pages, uuid_str, info)
+        else:
+            prepared.stored_text = await run_in_threadpool(_load_full_text, uuid_str)
+    if stream:
+        return StreamingResponse(
+            _stream_answer(uuid_str, prepared, llm_responce),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    coalesced = False
+    if not cached:
+        try:
+            llm_responce, coalesced = await _answer(uuid_str, prepared)
+        except UpstreamUnavailable as e:
+            # Every backend for this context is failing; tell the client when to come back
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(BREAKER_RESET))})
+        except ValueError as e:
+            # Rejected by the backends or misconfigured (e.g. no API key); retrying will not help
+            raise HTTPException(status_code=500, detail=str(e))
+    response = {
+        "uuid": uuid_str, "query": query, "llm_responce": llm_responce, "cached": cached, "coalesced": coalesced,
+        **prepared.context_info,
+    }
+    if prepared.cite_pages:
+        response["pages_cited"] = cited_pages(llm_responce, prepared.page_count)
+    return response
+
+def _summary_answer(uuid_str: str, query: str, info: dict, summary: dict, stream: bool):
+    # "What is this document about?" answered from the summary made at ingest, with no LLM call
+    prepared = PreparedQuery(query, "summary", info["digest"])
+    prepared.context_info = {"mode": "summary", "tokens_sent": 0, "tokens_full": info["tokens"], "context_trimmed": False}
+    if stream:
+        return StreamingResponse(
+            _stream_answer(uuid_str, prepared, summary["text"]),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return {
+        "uuid": uuid_str, "query": query, "llm_responce": summary["text"], "cached": True, "coalesced": False,
+        **prepared.context_info,
+    }
+
+class BatchQueryRequest(BaseModel):
+    questions: List[Annotated[str, Field(min_length=1)]] = Field(..., min_length=1, max_length=BATCH_MAX_QUESTIONS)
+    mode: Literal["auto", "full", "retrieval"] = "auto"
+    # "packed" asks all questions in one completion, "concurrent" sends one request per question
+    strategy: Literal["auto", "packed", "concurrent"] = "auto"
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def _can_pack(pending: List[PreparedQuery], info: dict) -> bool:
+    # One completion over the shared full document, as long as the answers and the
+    # questions fit the completion and context budgets
+    if len(pending) < 2 or any(prepared.mode != "full" for prepared in pending):
+        return False
+    if len(pending) * _llm_backend(info["tokens"]).max_tokens > BATCH_PACK_MAX_TOKENS:
+        return False
+    questions = "\n".join(prepared.query for prepared in pending)
+    return info["tokens"] <= _llm_budget(info["tokens"], SYSTEM_INSTRUCTIONS, questions, max_tokens=BATCH_PACK_MAX_TOKENS)
+
+@router.post("/query/{uuid}/batch")
+async def batch_query_data(uuid: uuid_pkg.UUID, request: BatchQueryRequest):
     uuid_str = str(uuid)
-    if uuid_str not in data_store:
+    started = time.perf_counter()
+    info, pending_job = await run_in_threadpool(_lookup_document, uuid_str)
+    if pending_job is not None:
+        return pending_job
+    prepared_queries = [await _prepare_query(uuid_str, info, query, request.mode) for query in request.questions]
+    results = [None] * len(prepared_queries)
+
+    # Cached answers first; repeated questions are only asked once
+    pending = {}
+    for index, prepared in enumerate(prepared_queries):
+        llm_responce = answer_cache.get(prepared.cache_key)
+        if llm_responce is not None:
+            results[index] = {"llm_responce": llm_responce, "cached": True, "latency_ms": _elapsed_ms(started)}
+        else:
+            pending.setdefault(prepared.cache_key, []).append(index)
+    to_answer = [prepared_queries[indexes[0]] for indexes in pending.values()]
+
+    # Full-mode questions share one document text and one cacheable prefix
+    full_text = None
+    if any(prepared.mode == "full" for prepared in to_answer):
+        full_text = await run_in_threadpool(_load_full_text, uuid_str)
+        for prepared in to_answer:
+            if prepared.mode == "full":
+                prepared.stored_text = full_text
+
+    def record(prepared: PreparedQuery, llm_responce: str = None, error: str = None, call_started: float = started):
+        result = {"llm_responce": llm_responce, "cached": False, "latency_ms": _elapsed_ms(call_started)}
+        if error is not None:
+            result["error"] = error
+        for index in pending[prepared.cache_key]:
+            results[index] = result
+
+    strategy = "concurrent"
+    if request.strategy != "concurrent" and _can_pack(to_answer, info):
+        call_started = time.perf_counter()
+        try:
+            answers = await get_llm_batch_responce(
+                full_text, [prepared.query for prepared in to_answer], uuid=uuid_str, digest=info["digest"],
+                context_tokens=info["tokens"],
+            )
+        except ValueError as e:
+            logging.error(f"Packed batch query failed for UUID {uuid_str}: {e}")
+            answers = None
+        if answers is not None:
+            strategy = "packed"
+            for prepared, llm_responce in zip(to_answer, answers):
+                answer_cache.set(prepared.cache_key, llm_responce, prepared.cache_tag, prepared.digest)
+                record(prepared, llm_responce, call_started=call_started)
+            to_answer = []
+        else:
+            logging.info(f"Packed batch answer for UUID {uuid_str} was unusable, asking questions separately")
+
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+
+    async def answer(prepared: PreparedQuery) -> None:
+        async with semaphore:
+            call_started = time.perf_counter()
+            try:
+                llm_responce, _ = await _answer(uuid_str, prepared)
+            except ValueError as e:
+                # One failed question does not fail the batch
+                record(prepared, error=str(e), call_started=call_started)
+                return
+            record(prepared, llm_responce, call_started=call_started)
+
+    if to_answer:
+        # The first full-mode question goes alone so the provider caches the document
+        # prefix before the others arrive and reuse it
+        if len(to_answer) > 1 and to_answer[0].mode == "full":
+            await answer(to_answer[0])
+            to_answer = to_answer[1:]
+        await asyncio.gather(*(answer(prepared) for prepared in to_answer))
+
+    return {
+        "uuid": uuid_str,
+        "strategy": strategy,
+        "latency_ms": _elapsed_ms(started),
+        "answers": [
+            {"query": prepared.query, **result, **prepared.context_info}
+            for prepared, result in zip(prepared_queries, results)
+        ],
+    }
+
+class MultiQueryRequest(BaseModel):
+    query: str = Field(..., min_length=1)
+    uuids: Union[Literal["all"], List[uuid_pkg.UUID]] = "all"
+    # "map_reduce" answers per document first, then combines the answers
+    mode: Literal["auto", "full", "retrieval", "map_reduce"] = "auto"
+
+CITATION_INSTRUCTIONS = (
+    "\n\nThe context contains several documents, each introduced by a reference such as [1]. "
+    "Cite the documents that support each part of your answer using those references."
+)
+_CITATION_RE = re.compile(r"\[(\d+(?:\s*,\s*\d+)*)\]")
+
+def _label_documents(parts: List[Tuple[int, str, str]]) -> str:
+    return "\n\n".join(f"[{ref}] Document {uuid_str}\n{text}" for ref, uuid_str, text in parts)
+
+def _combined_context(parts: List[Tuple[int, str, str]], part_tokens: Optional[int]) -> Tuple[str, str, int]:
+    # Labelled context, its content hash and its token count, built off the event loop.
+    # part_tokens is the parts' known total; only the labels are counted then.
+    context = _label_documents(parts)
+    if part_tokens is None:
+        return context, content_hash(context), count_tokens(context)
+    labels = sum(count_tokens(f"[{ref}] Document {uuid_str}\n") for ref, uuid_str, _ in parts)
+    return context, content_hash(context), part_tokens + labels
+
+def _cited_refs(llm_responce: str) -> set:
+    return {int(ref) for group in _CITATION_RE.findall(llm_responce or "") for ref in group.split(",")}
+
+async def _bounded_gather(jobs: list, limit: int, timeout: float) -> list:
+    # Runs at most `limit` jobs at a time. Jobs still running at the deadline, or when the
+    # request itself is cancelled, are cancelled. Failures come back as exception objects.
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(job):
+        async with semaphore:
+            return await job()
+
+    tasks = [asyncio.create_task(run(job)) for job in jobs]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    results = []
+    for task in tasks:
+        if task not in done:
+            results.append(asyncio.TimeoutError(f"No answer within {timeout}s"))
+        else:
+            results.append(task.exception() or task.result())
+    return results
+
+async def _map_documents(documents: List[Tuple[int, str, dict]], query: str) -> List[dict]:
+    # Map step: answer the question against each document on its own. These are ordinary
+    # single-document answers, so they share the answer cache with GET /query.
+    async def answer(uuid_str: str, info: dict) -> dict:
+        prepared = await _prepare_query(uuid_str, info, query, "auto")
+        llm_responce = answer_cache.get(prepared.cache_key)
+        if llm_responce is not None:
+            return {"llm_responce": llm_responce, "cached": True, "tokens_sent": prepared.context_info["tokens_sent"]}
+        if prepared.stored_text is None:
+            prepared.stored_text = await run_in_threadpool(_load_full_text, uuid_str)
+        llm_responce, _ = await _answer(uuid_str, prepared)
+        return {"llm_responce": llm_responce, "cached": False, "tokens_sent": prepared.context_info["tokens_sent"]}
+
+    outcomes = await _bounded_gather(
+        [functools.partial(answer, uuid_str, info) for _, uuid_str, info in documents],
+        MULTI_QUERY_CONCURRENCY, MULTI_QUERY_TIMEOUT,
+    )
+    results = []
+    for (ref, uuid_str, _), outcome in zip(documents, outcomes):
+        if isinstance(outcome, BaseException):
+            logging.error(f"Map step failed for UUID {uuid_str}: {outcome}")
+            results.append({"ref": ref, "uuid": uuid_str, "llm_responce": None, "error": str(outcome) or type(outcome).__name__})
+        else:
+            results.append({"ref": ref, "uuid": uuid_str, **outcome})
+    return results
+
+def _document_infos(requested: List[str]) -> Tuple[List[Tuple[int, str, dict]], List[str]]:
+    documents = []
+    missing = []
+    for uuid_str in requested:
+        info = data_store.info(uuid_str)
+        if info is None:
+            missing.append(uuid_str)
+        else:
+            # References are numbered in request order and stay the same in every mode
+            documents.append((len(documents) + 1, uuid_str, info))
+    return documents, missing
+
+@router.post("/query")
+async def query_documents(request: MultiQueryRequest):
+    started = time.perf_counter()
+    if request.uuids == "all":
+        requested = await run_in_threadpool(data_store.keys)
+    else:
+        requested = list(dict.fromkeys(str(uuid) for uuid in request.uuids))
+    if len(requested) > MULTI_QUERY_MAX_DOCUMENTS:
         raise HTTPException(
-            status_code=404, detail=f"UUID {uuid_str} not found ."
+            status_code=400,
+            detail=f"A query can span at most {MULTI_QUERY_MAX_DOCUMENTS} documents, got {len(requested)}",
         )
-    stored_text = data_store[uuid_str]
-    llm_responce = get_llm_responce(context=stored_text, query=query)
-    return {"uuid": uuid_str, "query": query, "llm_responce": llm_responce}
+    documents, missing = await run_in_threadpool(_document_infos, requested)
+    if not documents:
+        raise HTTPException(status_code=404, detail="None of the requested documents were found .")
+
+    query = request.query
+    tokens_full = sum(info["tokens"] for _, _, info in documents)
+    budget = _llm_budget(tokens_full, SYSTEM_INSTRUCTIONS, query, CITATION_INSTRUCTIONS)
+    mode = request.mode
+    if mode == "auto":
+        mode = "full" if tokens_full <= min(FULL_CONTEXT_MAX_TOKENS, budget) else "retrieval"
+    context_trimmed = mode == "full" and tokens_full > budget
+    if context_trimmed:
+        mode = "retrieval"
+
+    map_results = None
+    if mode == "map_reduce":
+        map_results = await _map_documents(documents, query)
+        answered = [result for result in map_results if result["llm_responce"]]
+        if not answered:
+            raise HTTPException(status_code=502, detail="No document could be answered")
+        parts = [(result["ref"], result["uuid"], result["llm_responce"]) for result in answered]
+        tokens_sent = {result["ref"]: result["tokens_sent"] for result in answered}
+    elif mode == "full":
+        parts = [(ref, uuid_str, await run_in_threadpool(_load_full_text, uuid_str)) for ref, uuid_str, _ in documents]
+        tokens_sent = {ref: info["tokens"] for ref, _, info in documents}
+    else:
+        refs = {uuid_str: ref for ref, uuid_str, _ in documents}
+        selections = await run_in_threadpool(
+            retrieval_indexes.select_across,
+            [(uuid_str, _segment_blobs(info)) for _, uuid_str, info in documents],
+            data_store.blob_text, query, budget if context_trimmed else min(RETRIEVAL_TOKEN_BUDGET, budget),
+            max(RETRIEVAL_TOP_K, budget // RETRIEVAL_CHUNK_TOKENS) if context_trimmed else RETRIEVAL_TOP_K,
+        )
+        parts = [(refs[uuid_str], uuid_str, text) for uuid_str, text, _, _ in selections]
+        tokens_sent = {refs[uuid_str]: tokens for uuid_str, _, _, tokens in selections}
+
+    # The combined context is content-addressed, so any change to a document or to the
+    # selected passages produces a new key. Map answers are new text and have to be counted;
+    # documents and retrieved passages were counted at ingest.
+    context, cache_tag, context_tokens = await run_in_threadpool(
+        _combined_context, parts, None if mode == "map_reduce" else sum(tokens_sent.values())
+    )
+    backend = _llm_backend(context_tokens)
+    cache_key = answer_cache.make_key(
+        cache_tag, query, backend.model, backend.temperature, backend.max_tokens, context_mode=f"multi-{mode}"
+    )
+    llm_responce = answer_cache.get(cache_key)
+    cached = llm_responce is not None
+    coalesced = False
+    if not cached:
+        if mode == "map_reduce":
+            reduce_query = (
+                f"{query}\n\nThe context holds answers to this question taken from separate documents. "
+                "Combine them into one answer and leave out documents that do not contain the answer."
+            )
+        else:
+            reduce_query = query
+
+        async def call() -> str:
+            answer = await get_llm_responce(
+                context=context, query=reduce_query + CITATION_INSTRUCTIONS, context_tokens=context_tokens
+            )
+            answer_cache.set(cache_key, answer, cache_tag, *(info["digest"] for _, _, info in documents))
+            return answer
+
+        try:
+            llm_responce, coalesced = await llm_calls.do(cache_key, call)
+        except UpstreamUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(BREAKER_RESET))})
+        except ValueError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    cited = _cited_refs(llm_responce)
+    response = {
+        "query": query,
+        "mode": mode,
+        "llm_responce": llm_responce,
+        "cached": cached,
+        "coalesced": coalesced,
+        "citations": [
+            {"ref": ref, "uuid": uuid_str, "cited": ref in cited, "tokens_sent": tokens_sent[ref]}
+            for ref, uuid_str, _ in parts
+        ],
+        "missing": missing,
+        "tokens_sent": sum(tokens_sent.values()),
+        "tokens_full": tokens_full,
+        "context_trimmed": context_trimmed,
+        "latency_ms": _elapsed_ms(started),
+    }
+    if map_results is not None:
+        response["documents"] = map_results
+    return response
+
+def _sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def _done_event(uuid_str: str, prepared: PreparedQuery, llm_responce: str, **fields) -> str:
+    done = {"uuid": uuid_str, "query": prepared.query, **fields, **prepared.context_info}
+    if prepared.cite_pages:
+        done["pages_cited"] = cited_pages(llm_responce, prepared.page_count)
+    return _sse_event(done, event="done")
+
+async def _stream_answer(uuid_str: str, prepared: PreparedQuery, cached_answer: str = None):
+    # A cached answer is sent as a single token so clients handle both paths the same way
+    if cached_answer is not None:
+        yield _sse_event({"token": cached_answer})
+        yield _done_event(uuid_str, prepared, cached_answer, cached=True)
+        return
+
+    # Streams go through the single-flight like other answers: the first request streams
+    # the tokens as they arrive, and identical requests that arrive meanwhile (streamed or
+    # not) wait for the finished answer, which a stream receives as a single token
+    tokens = asyncio.Queue()
+
+    async def call() -> str:
+        parts = []
+        try:
+            async for token in stream_llm_responce(
+                context=prepared.stored_text, query=prepared.prompt, uuid=uuid_str, digest=prepared.prefix_digest,
+                context_tokens=prepared.context_tokens,
+            ):
+                parts.append(token)
+                tokens.put_nowait(token)
+        finally:
+            tokens.put_nowait(None)
+        # Record the full answer so the next identical question is served from cache
+        llm_responce = "".join(parts)
+        if llm_responce:
+            answer_cache.set(prepared.cache_key, llm_responce, prepared.cache_tag, prepared.digest)
+        logging.info(f"Streamed {len(parts)} chunks ({len(llm_responce)} chars) for UUID {uuid_str}")
+        return llm_responce
+
+    flight, shared = llm_calls.start(prepared.cache_key, call)
+    waiting = False
+    try:
+        if not shared:
+            while (token := await tokens.get()) is not None:
+                yield _sse_event({"token": token})
+        waiting = True
+        llm_responce = await llm_calls.wait(flight)
+    except Exception as e:
+        logging.error(f"Error while streaming LLM response for UUID {uuid_str}: {e}", exc_info=True)
+        yield _sse_event({"detail": str(e)}, event="error")
+        return
+    finally:
+        if not waiting:
+            # The client went away mid-stream; the call is cancelled unless others wait for it
+            llm_calls.leave(flight)
+    if shared:
+        yield _sse_event({"token": llm_responce})
+        yield _done_event(uuid_str, prepared, llm_responce, cached=False, coalesced=True)
+    else:
+        yield _done_event(uuid_str, prepared, llm_responce, cached=False)
 
 @router.delete("/data/{uuid}", status_code=200) 
 def delete_data(uuid: uuid_pkg.UUID):
     uuid_str = str(uuid)
-    if uuid_str not in data_store:
+    if ingest_queue.active_job(uuid_str):
+        raise HTTPException(
+            status_code=409, detail=f"UUID {uuid_str} is still being ingested, retry when the job is done"
+        )
+    digest = data_store.digest(uuid_str)
+    if digest is None or not data_store.delete(uuid_str):
         raise HTTPException(
             status_code=404, detail=f"UUID {uuid_str} not found ."
         )
-    del data_store[uuid_str]
+    # Identical documents under other UUIDs keep their cached answers
+    if not data_store.digest_in_use(digest):
+        answer_cache.invalidate(digest)
+    prompt_cache_stats.forget(uuid_str)
+    retrieval_indexes.drop(uuid_str)
     return {"message": f"Data for UUID {uuid_str} deleted successfully"}
 
 @router.get("/list_uuids")
 def list_all_uuids():
-    return {"uuids": list(data_store.keys())}
\ No newline at end of file
+    return {"uuids": data_store.keys()}
+
+@router.get("/store/stats")
+def document_store_stats():
+    return data_store.stats()
+
+@router.get("/cache/stats")
+def answer_cache_stats():
+    return {**answer_cache.stats(), "single_flight": llm_calls.stats()}
+
+@router.get("/cache/prompt")
+def prompt_cache_usage(uuid: uuid_pkg.UUID = None):
+    return prompt_cache_stats.stats(str(uuid) if uuid else None)
+
+@router.get("/documents/{uuid}/artifacts")
+def document_artifacts(uuid: uuid_pkg.UUID):
+    uuid_str = str(uuid)
+    info = data_store.info(uuid_str)
+    if info is None:
+        raise HTTPException(
+            status_code=404, detail=f"UUID {uuid_str} not found ."
+        )
+    segments = []
+    outline = []
+    for segment, first_page, artifacts in _document_pages(info):
+        segments.append({
+            "segment_id": segment["id"],
+            "first_page": first_page,
+            "pages": len(artifacts["pages"]),
+            "page_offsets": artifacts["pages"],
+        })
+        outline.extend({**entry, "page": first_page + entry["page"]} for entry in artifacts.get("outline", []))
+    summary = data_store.summary(info["digest"])
+    if summary is not None:
+        summary_status = "ready"
+    elif info["digest"] in _summaries_pending:
+        summary_status = "pending"
+    else:
+        summary_status = "disabled" if not DOCUMENT_SUMMARY else "missing"
+    return {
+        "uuid": uuid_str,
+        "digest": info["digest"],
+        "page_count": _page_count(info),
+        "segments": segments,
+        "outline": outline,
+        "summary": summary,
+        "summary_status": summary_status,
+    }
+
+@router.get("/llm/backends")
+def llm_backends_status():
+    # Configured backends with their circuit breaker state, and the routes between them
+    return llm_router.stats()
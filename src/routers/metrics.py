@@ -0,0 +1,121 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+import anyio
+import time
+
+from src.data_store import data_store
+from src.utils.answer_cache import answer_cache
+from src.utils.prompt_cache import prompt_cache_stats
+from src.utils.singleflight import llm_calls
+from src.utils.ingest import ingest_queue
+from src.utils.llm_client import llm_in_flight, llm_router, LLM_MAX_CONCURRENCY
+from src.utils.pdf_processor import PDF_WORKERS
+from src.utils.metrics import metrics, http_request_seconds
+
+router = APIRouter()
+
+
+class MetricsMiddleware:
+    # Times every HTTP request until its last body chunk is sent, so streamed answers
+    # are measured end to end. Requests are labelled by route template, not raw path.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_seconds.observe(
+                time.perf_counter() - started, method=scope["method"], route=route, status=str(status["code"])
+            )
+
+
+def _cache_metrics():
+    cache = answer_cache.stats()
+    flight = llm_calls.stats()
+    tokens = prompt_cache_stats.totals()
+    prompt_ratio = tokens["cached_tokens"] / tokens["prompt_tokens"] if tokens["prompt_tokens"] else 0.0
+    return [
+        ("cag_answer_cache_hits_total", "counter", "Answer cache hits", [({}, cache["hits"])]),
+        ("cag_answer_cache_misses_total", "counter", "Answer cache misses", [({}, cache["misses"])]),
+        ("cag_answer_cache_evictions_total", "counter", "Answer cache evictions", [({}, cache["evictions"])]),
+        ("cag_answer_cache_hit_ratio", "gauge", "Answer cache hits / lookups since start", [({}, cache["hit_ratio"])]),
+        ("cag_answer_cache_entries", "gauge", "Answers held in the cache", [({}, cache["entries"])]),
+        ("cag_answer_cache_bytes", "gauge", "Bytes held by the answer cache", [({}, cache["bytes"])]),
+        ("cag_llm_calls_total", "counter", "Upstream LLM calls started after coalescing", [({}, flight["calls"])]),
+        ("cag_llm_coalesced_total", "counter", "Requests that shared another request's LLM call", [({}, flight["coalesced"])]),
+        ("cag_llm_abandoned_total", "counter", "LLM calls cancelled after every waiting request went away", [({}, flight["abandoned"])]),
+        ("cag_llm_tokens_total", "counter", "Tokens reported by the provider", [
+            ({"kind": "prompt"}, tokens["prompt_tokens"]),
+            ({"kind": "cached"}, tokens["cached_tokens"]),
+            ({"kind": "completion"}, tokens["completion_tokens"]),
+        ]),
+        ("cag_prompt_cache_hit_ratio", "gauge", "Cached prompt tokens / prompt tokens since start", [({}, prompt_ratio)]),
+    ]
+
+
+def _store_metrics():
+    store = data_store.stats()
+    labels = {"backend": store["backend"]}
+    return [
+        ("cag_store_documents", "gauge", "Documents in the store", [(labels, store["documents"])]),
+        ("cag_store_blobs", "gauge", "Distinct text blobs in the store", [(labels, store["blobs"])]),
+        ("cag_store_bytes", "gauge", "Uncompressed bytes held by the store", [(labels, store["bytes"])]),
+    ]
+
+
+def _saturation_metrics():
+    queue = ingest_queue.stats()
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return [
+        ("cag_ingest_queue_depth", "gauge", "Ingestion jobs waiting for a worker", [({}, queue["queued"])]),
+        ("cag_ingest_queue_capacity", "gauge", "Maximum queued ingestion jobs", [({}, queue["max_queued"])]),
+        ("cag_ingest_workers", "gauge", "Ingestion worker threads", [({}, queue["workers"])]),
+        ("cag_ingest_jobs", "gauge", "Known ingestion jobs by status", [
+            ({"status": status}, count) for status, count in queue["jobs"].items()
+        ]),
+        ("cag_threadpool_busy", "gauge", "Threads in use in the request threadpool", [({}, limiter.borrowed_tokens)]),
+        ("cag_threadpool_size", "gauge", "Request threadpool size", [({}, limiter.total_tokens)]),
+        ("cag_llm_in_flight", "gauge", "Upstream LLM requests holding a concurrency slot", [({}, llm_in_flight())]),
+        ("cag_llm_max_concurrency", "gauge", "Upstream LLM concurrency limit", [({}, LLM_MAX_CONCURRENCY)]),
+        ("cag_pdf_workers", "gauge", "PDF extraction worker processes", [({}, PDF_WORKERS)]),
+    ]
+
+
+def _backend_metrics():
+    backends = llm_router.stats()["backends"]
+    return [
+        ("cag_llm_backend_circuit_open", "gauge", "1 while a backend's circuit breaker is open or half-open", [
+            ({"backend": name}, int(backend["breaker"]["state"] != "closed")) for name, backend in backends.items()
+        ]),
+        ("cag_llm_backend_circuit_opened_total", "counter", "Times a backend's circuit breaker opened", [
+            ({"backend": name}, backend["breaker"]["times_opened"]) for name, backend in backends.items()
+        ]),
+    ]
+
+
+metrics.register_collector(_cache_metrics)
+metrics.register_collector(_store_metrics, blocking=True)
+metrics.register_collector(_saturation_metrics)
+metrics.register_collector(_backend_metrics)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    # Prometheus text exposition format. Store counts come from the database, so they are read off the event loop
+    store_families = await run_in_threadpool(metrics.collect_blocking)
+    return PlainTextResponse(metrics.render(store_families), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,62 @@
+import gc
+import os
+import time
+
+from src.data_store import data_store, STORE_PATH
+from src.utils.retrieval import retrieval_indexes, FULL_CONTEXT_MAX_TOKENS
+
+# Work done once when the app is imported, before the server starts taking requests.
+# With a forking server (gunicorn --preload) this runs in the master process, so
+# everything it loads is shared copy-on-write by the workers; with uvicorn --workers
+# each worker runs it, and only the OS page cache is shared.
+
+PRELOAD = os.environ.get("CAG_PRELOAD", "1").lower() in ("1", "true", "yes")
+# Build BM25 indexes for documents too large for full context; costs memory in every worker
+PRELOAD_INDEXES = os.environ.get("CAG_PRELOAD_INDEXES", "0").lower() in ("1", "true", "yes")
+
+
+def _warm_page_cache(path: str) -> int:
+    # The sqlite store is read through mmap; asking the kernel to read the file ahead
+    # (without reading it here) lets workers map resident pages instead of faulting
+    # them in from disk, and keeps startup time independent of the store size
+    if not os.path.isfile(path) or not hasattr(os, "posix_fadvise"):
+        return 0
+    with open(path, "rb", buffering=0) as fh:
+        os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return os.fstat(fh.fileno()).st_size
+
+
+def _build_indexes() -> int:
+    built = 0
+    for uuid in data_store.keys():
+        info = data_store.info(uuid)
+        if info is None or info["tokens"] <= FULL_CONTEXT_MAX_TOKENS:
+            continue
+        blobs = [segment["blob"] for segment in info["segments"]]
+        if retrieval_indexes.sync(uuid, blobs, data_store.blob_text) is not None:
+            built += 1
+    return built
+
+
+def preload() -> dict:
+    started = time.perf_counter()
+    stats = {"store_bytes": 0, "indexes": 0}
+    if PRELOAD:
+        try:
+            if data_store.backend.name == "sqlite":
+                # Recent writes may still sit in the write-ahead log
+                stats["store_bytes"] = _warm_page_cache(STORE_PATH) + _warm_page_cache(STORE_PATH + "-wal")
+            if PRELOAD_INDEXES:
+                stats["indexes"] = _build_indexes()
+        except Exception as e:
+            # A cold cache only slows the first requests down; never fail startup over it
+            print(f"Preload failed, continuing without it: {e}")
+        finally:
+            # Workers forked after this must open their own database connections
+            data_store.close()
+        # Objects created so far live as long as the process; moving them out of the
+        # collector's reach stops gc passes from touching (and un-sharing) their pages
+        gc.collect()
+        gc.freeze()
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
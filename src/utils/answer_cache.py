@@ -0,0 +1,148 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Answer cache in front of the LLM call.
+# Entries are keyed on the document content hash, the normalized query, the
+# model and the sampling parameters, so a changed document can never be served
+# a stale answer and identical documents under different UUIDs share answers.
+# Entries are also indexed by the digest of every document they were answered
+# from (besides the content they were keyed on, e.g. the retrieved chunks), so
+# the router can drop them eagerly once no UUID refers to that content any more.
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_query(query: str) -> str:
+    # Case, surrounding whitespace and trailing punctuation do not change the question
+    return " ".join(query.casefold().split()).rstrip(" ?!.")
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._entries = OrderedDict()  # key -> (answer, expires_at, size, digests)
+        self._keys_by_digest = {}
+        self._lock = threading.Lock()
+
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(digest: str, query: str, model: str, temperature: float, max_tokens: int, context_mode: str = "full") -> str:
+        raw = "\x1f".join([
+            digest, context_mode, normalize_query(query), model, repr(float(temperature)), str(int(max_tokens))
+        ])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            answer, expires_at, _, _ = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def set(self, key: str, answer: str, *digests: str) -> None:
+        # digests: the content tag the key was built from, plus the digest of each owning document
+        size = len(key) + len(answer.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        digests = frozenset(digest for digest in digests if digest)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (answer, time.monotonic() + self.ttl_seconds, size, digests)
+            for digest in digests:
+                self._keys_by_digest.setdefault(digest, set()).add(key)
+            self.current_bytes += size
+            while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, digest: str) -> int:
+        with self._lock:
+            keys = self._keys_by_digest.pop(digest, set())
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def transfer(self, old_digest: str, new_digest: str) -> int:
+        # A document changed from old_digest to new_digest. Answers keyed on the old
+        # whole-document content can never be asked for again and are dropped; answers
+        # keyed on other content (selected chunks, pages) still hit when that content is
+        # unchanged, so they now belong to the new digest. Returns the number dropped.
+        with self._lock:
+            dropped = 0
+            for key in self._keys_by_digest.pop(old_digest, set()):
+                answer, expires_at, size, digests = self._entries[key]
+                digests = digests - {old_digest}
+                if not digests:
+                    self._entries[key] = (answer, expires_at, size, digests)
+                    self._remove(key)
+                    dropped += 1
+                    continue
+                self._entries[key] = (answer, expires_at, size, digests | {new_digest})
+                self._keys_by_digest.setdefault(new_digest, set()).add(key)
+            self.invalidations += dropped
+            return dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_digest.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key: str) -> None:
+        # Caller must hold the lock
+        _, _, size, digests = self._entries.pop(key)
+        self.current_bytes -= size
+        for digest in digests:
+            keys = self._keys_by_digest.get(digest)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_digest[digest]
+
+
+answer_cache = AnswerCache(
+    max_entries=int(os.environ.get("CAG_ANSWER_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("CAG_ANSWER_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    ttl_seconds=float(os.environ.get("CAG_ANSWER_CACHE_TTL", "3600")),
+)
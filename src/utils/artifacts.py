@@ -0,0 +1,127 @@
+import bisect
+import os
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+# Per-document artifacts built once at ingest time instead of on every query:
+#   page map - character offset where each page starts in the stored text
+#   outline  - headings with their page, from PDF bookmarks or detected in the text
+#   summary  - optional LLM summary, generated in the background and keyed by digest
+
+# Summaries cost one LLM call per distinct document, so they are opt-in
+DOCUMENT_SUMMARY = os.environ.get("CAG_DOCUMENT_SUMMARY", "0").lower() in ("1", "true", "yes")
+SUMMARY_CONTEXT_TOKENS = int(os.environ.get("CAG_SUMMARY_CONTEXT_TOKENS", "12000"))
+OUTLINE_MAX_ENTRIES = int(os.environ.get("CAG_OUTLINE_MAX_ENTRIES", "200"))
+
+SUMMARY_PROMPT = (
+    "Summarize this document in one short paragraph: what it is, who it is for and its main points. "
+    "Then list its main sections."
+)
+PAGE_CITATION_INSTRUCTIONS = (
+    "\n\nThe context marks where each page starts with [Page N]. "
+    "Cite the pages that support your answer as (p. N)."
+)
+
+_NUMBERED_HEADING_RE = re.compile(r"^(\d{1,2}(?:\.\d{1,2}){0,3})\.?\s+([A-Z][^\n]{1,78})$")
+_KEYWORD_HEADING_RE = re.compile(r"^(chapter|section|part|appendix|annex)\s+[\dIVXLC]+[A-Z]?\b.{0,70}$", re.IGNORECASE)
+_PAGE_CITATION_RE = re.compile(r"\(pp?\.\s*(\d+)(?:\s*[-–]\s*(\d+))?\)")
+_OVERVIEW_RE = re.compile(
+    r"^(?:"
+    r"what(?:'s| is)(?: this| the)(?: document| pdf| file| paper| report| text)? about"
+    r"|what(?:'s| is) (?:this|the) (?:document|pdf|file|paper|report)"
+    r"|(?:summari[sz]e|give (?:me )?(?:a |an )?(?:summary|overview) of) (?:this|the|that) (?:document|pdf|file|paper|report|text)"
+    r"|(?:give (?:me )?)?(?:a |an )?(?:summary|overview|tl;?dr)(?: please| of (?:this|the) (?:document|pdf|file|paper|report))?"
+    r"|summari[sz]e(?: it)?"
+    r")$"
+)
+
+
+def join_pages(pages: List[str], separator: str = "\n") -> Tuple[str, List[int]]:
+    # Joins page texts and returns the offset where each page starts. Empty pages
+    # start where the next page does.
+    parts = []
+    offsets = []
+    length = 0
+    for page in pages:
+        if page and parts:
+            length += len(separator)
+        offsets.append(length)
+        if page:
+            parts.append(page)
+            length += len(page)
+    return separator.join(parts), offsets
+
+
+def page_at(offsets: List[int], offset: int) -> int:
+    # 0-based index of the page containing a character offset
+    return max(0, bisect.bisect_right(offsets, offset) - 1)
+
+
+def page_slices(text: str, offsets: List[int]) -> List[str]:
+    bounds = offsets[1:] + [len(text)]
+    return [text[start:end].strip() for start, end in zip(offsets, bounds)]
+
+
+def detect_headings(pages: List[str]) -> List[dict]:
+    # Numbered ("2.1 Scope"), keyword ("Chapter 3", "Appendix A") and short all-caps
+    # lines. Lines that repeat on several pages are running headers, not headings.
+    candidates = []
+    for page, text in enumerate(pages):
+        for line in text.splitlines():
+            line = line.strip()
+            if not 3 <= len(line) <= 80 or line.endswith((".", ",", ";", ":")):
+                continue
+            numbered = _NUMBERED_HEADING_RE.match(line)
+            if numbered:
+                candidates.append((line, page, numbered.group(1).count(".") + 1))
+            elif _KEYWORD_HEADING_RE.match(line):
+                candidates.append((line, page, 1))
+            elif line.isupper() and sum(char.isalpha() for char in line) >= 4 and len(line.split()) <= 8:
+                candidates.append((line.title(), page, 1))
+    repeats = Counter(title.casefold() for title, _, _ in candidates)
+    headings = []
+    for title, page, level in candidates:
+        if repeats[title.casefold()] > 2:
+            continue
+        headings.append({"title": title, "page": page, "level": level})
+        if len(headings) >= OUTLINE_MAX_ENTRIES:
+            break
+    return headings
+
+
+def build_outline(pages: List[str], bookmarks: Optional[List[dict]] = None) -> List[dict]:
+    # The PDF's own bookmarks are authoritative when it has them
+    if bookmarks:
+        return bookmarks[:OUTLINE_MAX_ENTRIES]
+    return detect_headings(pages)
+
+
+def parse_page_range(spec: str, page_count: int) -> Tuple[int, int]:
+    # "3" or "3-7", 1-based and inclusive
+    start, _, end = spec.strip().partition("-")
+    try:
+        first = int(start)
+        last = int(end) if end.strip() else first
+    except ValueError:
+        raise ValueError(f"Invalid page range '{spec}', expected N or N-M")
+    if first < 1 or last < first:
+        raise ValueError(f"Invalid page range '{spec}'")
+    if first > page_count:
+        raise ValueError(f"Page {first} is past the end of the document ({page_count} pages)")
+    return first, min(last, page_count)
+
+
+def cited_pages(answer: str, page_count: int) -> List[int]:
+    pages = set()
+    for start, end in _PAGE_CITATION_RE.findall(answer or ""):
+        first = int(start)
+        last = int(end) if end else first
+        pages.update(page for page in range(first, min(last, first + 50) + 1) if 1 <= page <= page_count)
+    return sorted(pages)
+
+
+def is_overview_question(query: str) -> bool:
+    # "What is this document about?", "Summarize the PDF", "tl;dr" and the like
+    normalized = " ".join(query.casefold().replace("’", "'").split()).strip(" ?.!")
+    return bool(_OVERVIEW_RE.match(normalized))
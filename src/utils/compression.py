@@ -0,0 +1,76 @@
+import os
+import re
+from collections import Counter
+from typing import List, Optional
+
+# Lossless-enough cleanup of extracted PDF text before it is stored.
+# pypdf output carries running headers and footers on every page, page
+# numbers, hyphenated line breaks and runs of blank lines; all of these cost
+# tokens on every query without helping the answer.
+
+COMPRESS_CONTEXT = os.environ.get("CAG_COMPRESS_CONTEXT", "0").lower() in ("1", "true", "yes")
+# A line must appear on at least this share of pages to count as a header or footer
+HEADER_FOOTER_MIN_SHARE = float(os.environ.get("CAG_HEADER_FOOTER_MIN_SHARE", "0.5"))
+HEADER_FOOTER_LINES = 3  # lines checked at the top and bottom of each page
+BOILERPLATE_MIN_CHARS = 40  # shorter paragraphs may legitimately repeat
+
+_DIGITS_RE = re.compile(r"\d+")
+_SPACES_RE = re.compile(r"[ \t\u00a0]+")
+_HYPHEN_BREAK_RE = re.compile(r"(\w)-\n(\w)")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def _line_signature(line: str) -> str:
+    # Page numbers differ from page to page, so digits are ignored when matching
+    return _DIGITS_RE.sub("#", line.strip().casefold())
+
+
+def normalize_whitespace(text: str) -> str:
+    text = _HYPHEN_BREAK_RE.sub(r"\1\2", text)
+    lines = [_SPACES_RE.sub(" ", line).strip() for line in text.splitlines()]
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+def strip_headers_footers(pages: List[str]) -> List[str]:
+    if len(pages) < 3:
+        return pages
+    page_lines = [page.splitlines() for page in pages]
+    counts = Counter()
+    for lines in page_lines:
+        edge = lines[:HEADER_FOOTER_LINES] + lines[-HEADER_FOOTER_LINES:]
+        counts.update({_line_signature(line) for line in edge if line.strip()})
+    min_pages = max(2, int(len(pages) * HEADER_FOOTER_MIN_SHARE))
+    repeated = {signature for signature, count in counts.items() if count >= min_pages}
+    if not repeated:
+        return pages
+
+    cleaned = []
+    for lines in page_lines:
+        top, bottom = 0, len(lines)
+        while top < min(HEADER_FOOTER_LINES, bottom) and (not lines[top].strip() or _line_signature(lines[top]) in repeated):
+            top += 1
+        while bottom > max(top, len(lines) - HEADER_FOOTER_LINES) and (not lines[bottom - 1].strip() or _line_signature(lines[bottom - 1]) in repeated):
+            bottom -= 1
+        cleaned.append("\n".join(lines[top:bottom]))
+    return cleaned
+
+
+def remove_repeated_paragraphs(text: str, seen: Optional[set] = None) -> str:
+    # Keeps the first copy of long paragraphs that repeat verbatim (disclaimers, legal notices);
+    # pass the same `seen` set to carry this across pages
+    seen = set() if seen is None else seen
+    kept = []
+    for paragraph in text.split("\n\n"):
+        if len(paragraph) >= BOILERPLATE_MIN_CHARS:
+            signature = " ".join(paragraph.casefold().split())
+            if signature in seen:
+                continue
+            seen.add(signature)
+        kept.append(paragraph)
+    return "\n\n".join(kept)
+
+
+def compress_page_texts(pages: List[str]) -> List[str]:
+    # One cleaned text per page, so page boundaries survive
+    seen = set()
+    return [remove_repeated_paragraphs(normalize_whitespace(page), seen) for page in strip_headers_footers(pages)]
@@ -0,0 +1,150 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid as uuid_pkg
+from typing import Callable, Optional
+
+# Background ingestion queue.
+# Uploads return as soon as the file is on disk; extraction, storing and
+# indexing run on a small pool of worker threads fed by a bounded queue. Job
+# progress is kept in memory so clients can poll it.
+
+INGEST_WORKERS = int(os.environ.get("CAG_INGEST_WORKERS", "2"))
+INGEST_QUEUE_SIZE = int(os.environ.get("CAG_INGEST_QUEUE_SIZE", "32"))
+INGEST_JOB_TTL = float(os.environ.get("CAG_INGEST_JOB_TTL", "3600"))  # seconds finished jobs stay queryable
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestJob:
+    def __init__(self, uuid: str, kind: str, size_bytes: int, sha256: Optional[str] = None):
+        self.job_id = str(uuid_pkg.uuid4())
+        self.uuid = uuid
+        self.kind = kind
+        self.status = "queued"
+        self.bytes = size_bytes
+        self.sha256 = sha256
+        self.deduplicated = False
+        self.segment_id = None
+        self.pages_total = None
+        self.pages_processed = 0
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def progress(self, pages_processed: int, pages_total: int) -> None:
+        self.pages_processed = pages_processed
+        self.pages_total = pages_total
+
+    def to_dict(self) -> dict:
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "uuid": self.uuid,
+            "kind": self.kind,
+            "status": self.status,
+            "bytes": self.bytes,
+            "sha256": self.sha256,
+            "deduplicated": self.deduplicated,
+            "segment_id": self.segment_id,
+            "pages_total": self.pages_total,
+            "pages_processed": self.pages_processed,
+            "queued_seconds": round((self.started_at or end) - self.created_at, 3),
+            "duration_seconds": round(end - self.started_at, 3) if self.started_at else None,
+            "error": self.error,
+        }
+
+
+class IngestQueue:
+    def __init__(self, workers: int = INGEST_WORKERS, max_queued: int = INGEST_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._active_by_uuid = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _ensure_workers(self) -> None:
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"cag-ingest-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self) -> None:
+        while True:
+            job, work = self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                work(job)
+                job.status = "done"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                logging.exception(f"Ingestion job {job.job_id} for UUID {job.uuid} failed: {e}")
+            finally:
+                job.finished_at = time.time()
+                with self._lock:
+                    if self._active_by_uuid.get(job.uuid) is job:
+                        del self._active_by_uuid[job.uuid]
+                self._queue.task_done()
+
+    def _prune(self) -> None:
+        # Caller must hold the lock
+        cutoff = time.time() - INGEST_JOB_TTL
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def submit(self, uuid: str, kind: str, size_bytes: int, work: Callable[[IngestJob], None],
+               sha256: Optional[str] = None) -> IngestJob:
+        # Only one job per UUID at a time, so an update can never overtake its upload
+        self._ensure_workers()
+        job = IngestJob(uuid, kind, size_bytes, sha256)
+        with self._lock:
+            self._prune()
+            if uuid in self._active_by_uuid:
+                raise ValueError(f"UUID {uuid} already has an ingestion job in progress")
+            # Register before enqueueing so a fast worker cannot finish an unregistered job
+            self._jobs[job.job_id] = job
+            self._active_by_uuid[uuid] = job
+            try:
+                self._queue.put_nowait((job, work))
+            except queue.Full:
+                del self._jobs[job.job_id]
+                del self._active_by_uuid[uuid]
+                raise IngestQueueFull("Ingestion queue is full, retry later")
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_job(self, uuid: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._active_by_uuid.get(uuid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {
+                "workers": self.workers,
+                "queued": self._queue.qsize(),
+                "max_queued": self._queue.maxsize,
+                "jobs": statuses,
+            }
+
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from src.utils.prompt_cache import KVSlotRegistry
+from src.utils.tokens import context_limit as model_context_limit
+
+# LLM backends and routing.
+# A backend is one OpenAI-compatible chat-completions endpoint with its own
+# model, sampling parameters, timeout and circuit breaker. Routes pick an
+# ordered list of backends by context size: the first backend answers, the
+# rest are failovers, and an optional hedge delay races the second backend
+# against a slow first one.
+#
+# Configuration is JSON, inline in CAG_LLM_BACKENDS or in the file it names:
+#
+#   {"backends": {"fast": {"model": "openai/gpt-5-mini"},
+#                 "long": {"model": "google/gemini-2.5-pro", "timeout": 120},
+#                 "local": {"provider": "llamacpp", "api_base": "http://127.0.0.1:8080/v1/chat/completions"}},
+#    "routes": [{"max_context_tokens": 16000, "backends": ["fast", "local"], "hedge_after": 3},
+#               {"backends": ["long", "fast"]}]}
+#
+# Without it there is one backend built from the CAG_LLM_* settings.
+
+OPENROUTER_API_BASE = "https://openrouter.ai/api/v1/chat/completions"
+LLAMACPP_API_BASE = "http://127.0.0.1:8080/v1/chat/completions"
+
+BREAKER_FAILURES = int(os.environ.get("CAG_LLM_BREAKER_FAILURES", "5"))  # consecutive failures before opening
+BREAKER_RESET = float(os.environ.get("CAG_LLM_BREAKER_RESET", "30"))  # seconds before a trial request
+
+
+class UpstreamUnavailable(ValueError):
+    # The backend did not answer (timeouts, connection errors, retryable statuses
+    # until retries ran out). Only these count against its circuit breaker.
+    pass
+
+
+class BackendMisconfigured(ValueError):
+    # The backend cannot be called as configured (e.g. its API key is not set). This is
+    # not an outage, so it never counts against the circuit breaker.
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        # Closed: always. Open: never, until reset_timeout has passed; then one trial request (half-open).
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def release(self) -> None:
+        # A trial request that ended without a verdict (e.g. cancelled) frees the trial slot
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "times_opened": self.times_opened}
+
+
+class Backend:
+    def __init__(self, name: str, model: str, provider: str = "openrouter", api_base: Optional[str] = None,
+                 temperature: float = 0.2, max_tokens: int = 500, context_limit: Optional[int] = None,
+                 timeout: float = 60.0, max_retries: int = 3, api_key_env: Optional[str] = None,
+                 llamacpp_slots: int = 1):
+        self.name = name
+        self.model = model
+        self.provider = provider
+        self.api_base = api_base or (OPENROUTER_API_BASE if provider == "openrouter" else LLAMACPP_API_BASE)
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.context_limit = context_limit or model_context_limit(model)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # Only OpenRouter backends fall back to the OpenRouter key; any other endpoint gets
+        # a key only when its own variable is configured, so the secret never leaks to it
+        self.api_key_env = api_key_env or ("OPENROUTER_API_KEY" if provider == "openrouter" else None)
+        self.breaker = CircuitBreaker()
+        # llama.cpp servers keep one KV cache per slot; track them per server
+        self.kv_slots = KVSlotRegistry(llamacpp_slots) if provider == "llamacpp" else None
+
+    @property
+    def is_llamacpp(self) -> bool:
+        return self.provider == "llamacpp"
+
+    def headers(self) -> dict:
+        api_key = os.environ.get(self.api_key_env) if self.api_key_env else None
+        if self.provider != "openrouter":
+            # Local servers usually run without auth
+            headers = {"Content-Type": "application/json"}
+            if api_key:
+                headers["Authorization"] = f"Bearer {api_key}"
+            return headers
+        if not api_key:
+            raise BackendMisconfigured(
+                f"{self.api_key_env} environment Variable is not set. "
+                "Please set it to your OpenRouter API key."
+            )
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "your-app-name-or-url",   # optional
+            "X-OpenRouter-Title": "Your App Name"     # fixed header
+        }
+
+    def server_root(self) -> str:
+        return self.api_base.split("/v1/", 1)[0]
+
+    def config_error(self) -> Optional[str]:
+        # Checked before the breaker is asked, so a configuration mistake is reported as such
+        try:
+            self.headers()
+        except BackendMisconfigured as e:
+            return str(e)
+        return None
+
+    def fits(self, context_tokens: int) -> bool:
+        return context_tokens + self.max_tokens <= self.context_limit
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "api_base": self.api_base,
+            "context_limit": self.context_limit,
+            "timeout": self.timeout,
+            "breaker": self.breaker.stats(),
+        }
+
+
+class Route:
+    def __init__(self, backends: List[Backend], max_context_tokens: Optional[int] = None, hedge_after: Optional[float] = None):
+        if not backends:
+            raise ValueError("A route needs at least one backend")
+        self.backends = backends
+        self.max_context_tokens = max_context_tokens
+        self.hedge_after = hedge_after
+
+    @property
+    def primary(self) -> Backend:
+        # Decides the model and sampling parameters in the answer cache key
+        return self.backends[0]
+
+    @property
+    def context_limit(self) -> int:
+        return max(backend.context_limit for backend in self.backends)
+
+    def candidates(self, context_tokens: int) -> List[Backend]:
+        # Backends in failover order that can take the context. Breakers are asked only
+        # right before a backend is called, so a half-open trial is never claimed unused.
+        return [backend for backend in self.backends if backend.fits(context_tokens)]
+
+    def stats(self) -> dict:
+        return {
+            "max_context_tokens": self.max_context_tokens,
+            "backends": [backend.name for backend in self.backends],
+            "hedge_after": self.hedge_after,
+        }
+
+
+class BackendRouter:
+    def __init__(self, backends: List[Backend], routes: List[Route]):
+        self.backends = {backend.name: backend for backend in backends}
+        self.routes = routes
+
+    def route_for(self, context_tokens: int) -> Route:
+        # First route whose limit covers the context; the last route takes everything larger
+        for route in self.routes:
+            if route.max_context_tokens is None or context_tokens <= route.max_context_tokens:
+                return route
+        return self.routes[-1]
+
+    def stats(self) -> dict:
+        return {
+            "backends": {name: backend.stats() for name, backend in self.backends.items()},
+            "routes": [route.stats() for route in self.routes],
+        }
+
+
+def _read_config(raw: str) -> dict:
+    raw = raw.strip()
+    if not raw.startswith("{"):
+        with open(raw) as fh:
+            raw = fh.read()
+    return json.loads(raw)
+
+
+def load_router(default: Backend, raw_config: Optional[str] = None) -> BackendRouter:
+    raw_config = raw_config if raw_config is not None else os.environ.get("CAG_LLM_BACKENDS", "")
+    if not raw_config.strip():
+        return BackendRouter([default], [Route([default])])
+
+    config = _read_config(raw_config)
+    backends = {}
+    for name, settings in config.get("backends", {}).items():
+        settings = dict(settings)
+        # Unset fields inherit the default backend's settings
+        for field in ("model", "temperature", "max_tokens", "timeout", "max_retries"):
+            settings.setdefault(field, getattr(default, field))
+        backends[name] = Backend(name, **settings)
+    if not backends:
+        raise ValueError("CAG_LLM_BACKENDS defines no backends")
+
+    routes = []
+    for settings in config.get("routes") or [{"backends": list(backends)}]:
+        missing = [name for name in settings["backends"] if name not in backends]
+        if missing:
+            raise ValueError(f"Route refers to unknown backends: {', '.join(missing)}")
+        routes.append(Route(
+            [backends[name] for name in settings["backends"]],
+            max_context_tokens=settings.get("max_context_tokens"),
+            hedge_after=settings.get("hedge_after"),
+        ))
+    routes.sort(key=lambda route: float("inf") if route.max_context_tokens is None else route.max_context_tokens)
+    return BackendRouter(list(backends.values()), routes)
@@ -1,40 +1,164 @@
+import asyncio
+import json
 import os
-import requests
-from dotenv import load_dotenv, find_dotenv
+import random
+import time
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 
-# Load Environment variables from .env file
-load_dotenv(find_dotenv())
+import httpx
 
-def get_llm_responce(context: str, query: str) -> str:
+from src.utils.llm_backends import Backend, BackendMisconfigured, Route, UpstreamUnavailable, OPENROUTER_API_BASE, LLAMACPP_API_BASE, load_router
+from src.utils.metrics import stage_seconds, upstream_requests, upstream_failovers, upstream_hedges
+from src.utils.prompt_cache import prompt_cache_stats
+from src.utils.tokens import count_tokens
 
-    api_key = os.environ.get("OPENROUTER_API_KEY")
-    if not api_key:
-        raise ValueError(
-            "OPENROUTER_API_KEY environment Variable is not set. "
-            "Please set it to your OpenRouter API key."
+
+def _find_env_file() -> Optional[str]:
+    # Same search as dotenv.find_dotenv(): this file's directory, then its parents
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, ".env")
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+# Load Environment variables from .env file; python-dotenv is only imported when there is one
+_env_file = _find_env_file()
+if _env_file:
+    from dotenv import load_dotenv
+    load_dotenv(_env_file)
+
+# Provider: "openrouter" (hosted) or "llamacpp" (local llama.cpp server, KV cache kept per document)
+LLM_PROVIDER = os.environ.get("CAG_LLM_PROVIDER", "openrouter")
+LLM_API_BASE = os.environ.get(
+    "CAG_LLM_API_BASE",
+    OPENROUTER_API_BASE if LLM_PROVIDER == "openrouter" else LLAMACPP_API_BASE,
+)
+
+# Prompt prefix caching: "auto" sends cache_control hints only to providers that need them
+PROMPT_CACHE_CONTROL = os.environ.get("CAG_PROMPT_CACHE_CONTROL", "auto")
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/")
+LLAMACPP_SLOTS = int(os.environ.get("CAG_LLAMACPP_SLOTS", "1"))
+LLAMACPP_SAVE_KV = os.environ.get("CAG_LLAMACPP_SAVE_KV", "1") == "1"
+
+SYSTEM_INSTRUCTIONS = (
+    "You are an intelligent and precise assistant. "
+    "Your primary task is to answer user questions based *solely* on the 'PROVIDED DOCUMENT CONTEXT'. "
+    "Read the context carefully before formulating your response. "
+    "If the information needed to answer the question is not explicitly available in the provided document, "
+    "state clearly that the answer cannot be found in the document. "
+    "Do not introduce outside information or make assumptions.\n\n"
+)
+
+# Model and sampling parameters of the default backend (also part of the answer cache key)
+LLM_MODEL = "openai/gpt-5.2"
+LLM_TEMPERATURE = 0.2
+LLM_MAX_TOKENS = 500
+# Completion budget for several questions answered in one packed request
+BATCH_PACK_MAX_TOKENS = int(os.environ.get("CAG_BATCH_PACK_MAX_TOKENS", "4000"))
+
+# Connection pool, concurrency and retry settings
+LLM_MAX_CONNECTIONS = int(os.environ.get("CAG_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("CAG_LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("CAG_LLM_MAX_CONCURRENCY", "256"))
+LLM_TIMEOUT = float(os.environ.get("CAG_LLM_TIMEOUT", "60"))  # deadline per request, retries included
+LLM_MAX_RETRIES = int(os.environ.get("CAG_LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.environ.get("CAG_LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.environ.get("CAG_LLM_BACKOFF_MAX", "8"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# Backends and context-size routes (see llm_backends); without CAG_LLM_BACKENDS
+# this is a single backend built from the settings above
+llm_router = load_router(Backend(
+    "default", LLM_MODEL, provider=LLM_PROVIDER, api_base=LLM_API_BASE, temperature=LLM_TEMPERATURE,
+    max_tokens=LLM_MAX_TOKENS, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES, llamacpp_slots=LLAMACPP_SLOTS,
+))
+KV_WARMUP_ENABLED = any(backend.is_llamacpp for backend in llm_router.backends.values())
+
+_client: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_client() -> httpx.AsyncClient:
+    # One shared pool for the whole process; headers are per backend, set on each request
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=LLM_TIMEOUT,
         )
+    return _client
 
-    OPENROUTER_API_BASE = "https://openrouter.ai/api/v1/chat/completions"
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "your-app-name-or-url",   # optional
-        "X-OpenRouter-Title": "Your App Name"     # fixed header
-    }
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _semaphore
+
 
-    messages = [
+def llm_in_flight() -> int:
+    # Upstream requests currently holding a concurrency slot
+    if _semaphore is None:
+        return 0
+    return LLM_MAX_CONCURRENCY - _semaphore._value
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _backoff_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    # Honour Retry-After when the provider sends one, otherwise full-jitter exponential backoff
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), LLM_BACKOFF_MAX)
+            except ValueError:
+                pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _use_cache_control(backend: Backend) -> bool:
+    if PROMPT_CACHE_CONTROL in ("on", "off"):
+        return PROMPT_CACHE_CONTROL == "on"
+    return backend.provider == "openrouter" and backend.model.startswith(CACHE_CONTROL_MODEL_PREFIXES)
+
+
+def build_messages(context: str, query: str, cache_control: bool = False) -> list:
+    # Instructions + document form a byte-identical prefix for a given document and the
+    # question always comes last, so provider-side prefix caches can reuse the prefill
+    prefix = SYSTEM_INSTRUCTIONS + f"PROVIDED DOCUMENT CONTEXT:\n```\n{context}\n```"
+    if cache_control:
+        system_content = [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}]
+    else:
+        system_content = prefix
+    return [
         {
             "role": "system",
-            "content": (
-                "You are an intelligent and precise assistant. "
-                "Your primary task is to answer user questions based *solely* on the 'PROVIDED DOCUMENT CONTEXT'. "
-                "Read the context carefully before formulating your response. "
-                "If the information needed to answer the question is not explicitly available in the provided document, "
-                "state clearly that the answer cannot be found in the document. "
-                "Do not introduce outside information or make assumptions.\n\n"
-                f"PROVIDED DOCUMENT CONTEXT:\n```\n{context}\n```"
-            )
+            "content": system_content
         },
         {
             "role": "user",
@@ -42,31 +166,384 @@ def get_llm_responce(context: str, query: str) -> str:
         }
     ]
 
+
+async def _send_with_retries(backend: Backend, payload: dict, stream: bool = False,
+                             timeout: Optional[float] = None) -> httpx.Response:
+    # Retries only happen before the response body is consumed, so streamed
+    # responses are never replayed half-way through
+    client = get_client()
+    loop = asyncio.get_running_loop()
+    timeout = timeout or backend.timeout
+    deadline = loop.time() + timeout
+    started = time.perf_counter()
+
+    attempt = 0
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            upstream_requests.inc(backend=backend.name, outcome="error")
+            raise UpstreamUnavailable(f"LLM backend '{backend.name}' exceeded its {timeout}s deadline")
+        response = None
+        try:
+            request = client.build_request(
+                "POST",
+                backend.api_base,
+                json=payload,
+                headers=backend.headers(),
+                timeout=httpx.Timeout(remaining, connect=min(10.0, remaining)),
+            )
+            # Always sent streaming so time to first byte can be measured; plain calls read the body below
+            response = await client.send(request, stream=True)
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                if response.is_error:
+                    await response.aread()
+                    upstream_requests.inc(backend=backend.name, outcome="error")
+                    response.raise_for_status()
+                stage_seconds.observe(time.perf_counter() - started, stage="upstream_ttfb")
+                if not stream:
+                    await response.aread()
+                upstream_requests.inc(backend=backend.name, outcome="ok")
+                return response
+            await response.aclose()
+            error = f"HTTP {response.status_code}"
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            error = repr(e)
+
+        if attempt >= backend.max_retries:
+            upstream_requests.inc(backend=backend.name, outcome="error")
+            raise UpstreamUnavailable(
+                f"Failed to connect to LLM backend '{backend.name}' after {attempt + 1} attempts: {error}"
+            )
+        delay = min(_backoff_delay(attempt, response), max(0.0, deadline - loop.time()))
+        print(f"Retrying LLM backend '{backend.name}' in {delay:.2f}s ({error})")
+        upstream_requests.inc(backend=backend.name, outcome="retry")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _post_chat_completion(backend: Backend, payload: dict, timeout: Optional[float] = None) -> dict:
+    async with _get_semaphore():
+        with stage_seconds.time(stage="upstream_total"):
+            response = await _send_with_retries(backend, payload, timeout=timeout)
+        return response.json()
+
+
+def _build_payload(backend: Backend, context: str, query: str, stream: bool = False, digest: Optional[str] = None) -> dict:
+    payload = {
+        "model": backend.model,
+        "messages": build_messages(context, query, _use_cache_control(backend)),
+        "temperature": backend.temperature,
+        "max_tokens": backend.max_tokens
+    }
+    if stream:
+        payload["stream"] = True
+        # Ask for a final usage chunk so cached-token counts are tracked for streams too
+        payload["stream_options"] = {"include_usage": True}
+    if backend.is_llamacpp:
+        payload["cache_prompt"] = True
+        if digest:
+            payload["id_slot"] = backend.kv_slots.slot_for(digest)
+    return payload
+
+
+def _kv_filename(digest: str) -> str:
+    return f"cag-{digest}.bin"
+
+
+async def _ensure_kv_resident(backend: Backend, digest: str) -> None:
+    # Restore a document's saved KV cache into its slot before querying it
+    kv_slots = backend.kv_slots
+    slot = kv_slots.slot_for(digest)
+    if kv_slots.is_resident(slot, digest) or not kv_slots.is_saved(digest):
+        return
     try:
-        response = requests.post(
-            url=OPENROUTER_API_BASE,
-            headers=headers,
-            json={
-                "model": "openai/gpt-5.2",   # updated model
-                "messages": messages,
-                "temperature": 0.2,
-                "max_tokens": 500
-            },
-            timeout=60
+        response = await get_client().post(
+            f"{backend.server_root()}/slots/{slot}",
+            params={"action": "restore"},
+            json={"filename": _kv_filename(digest)},
+            headers=backend.headers(),
         )
-
         response.raise_for_status()
-        response_data = response.json()
+        kv_slots.mark_resident(slot, digest)
+    except httpx.HTTPError as e:
+        # Not fatal: the server simply prefills the prompt again
+        print(f"KV cache restore failed for slot {slot} on '{backend.name}': {e}")
+
 
-        if response_data and "choices" in response_data and response_data["choices"]:
-            return response_data["choices"][0]["message"]["content"]
-        else:
-            print(f"No valid response: {response_data}")
-            return "No response from LLM."
+async def warm_document_cache(uuid: str, digest: str, context: str) -> None:
+    # Precompute the document's KV cache on the local servers that would answer it and save it
+    # to disk, so later queries only prefill the question. Hosted providers warm their cache on first use.
+    route = llm_router.route_for(count_tokens(context))
+    for backend in route.backends:
+        if not backend.is_llamacpp or backend.kv_slots.is_saved(digest):
+            continue
+        kv_slots = backend.kv_slots
+        slot = kv_slots.slot_for(digest)
+        payload = _build_payload(backend, context, "Reply with OK.", digest=digest)
+        payload["max_tokens"] = 1
+        try:
+            await _post_chat_completion(backend, payload)
+            kv_slots.mark_resident(slot, digest)
+            if LLAMACPP_SAVE_KV:
+                response = await get_client().post(
+                    f"{backend.server_root()}/slots/{slot}",
+                    params={"action": "save"},
+                    json={"filename": _kv_filename(digest)},
+                    headers=backend.headers(),
+                )
+                response.raise_for_status()
+                kv_slots.mark_saved(digest)
+        except (ValueError, httpx.HTTPError) as e:
+            print(f"KV cache warm-up failed for UUID {uuid} on '{backend.name}': {e}")
 
-    except requests.exceptions.RequestException as e:
+
+async def _call_backend(backend: Backend, payload: dict, uuid: Optional[str] = None, digest: Optional[str] = None) -> str:
+    # One completion from one backend, keeping its circuit breaker up to date. Everything
+    # after breaker.allow() is inside the try, so a cancellation anywhere frees a half-open trial.
+    try:
+        if backend.is_llamacpp and digest:
+            await _ensure_kv_resident(backend, digest)
+        response_data = await _post_chat_completion(backend, payload)
+    except UpstreamUnavailable:
+        backend.breaker.record_failure()
+        raise
+    except (asyncio.CancelledError, BackendMisconfigured):
+        # Lost a hedge race, the caller went away or the backend is misconfigured;
+        # none of these says anything about the backend's health
+        backend.breaker.release()
+        raise
+    except httpx.HTTPError as e:
+        # The backend answered, with an error status (e.g. a request it rejects)
+        backend.breaker.record_success()
         print(f"Request error: {e}")
-        raise ValueError(f"Failed to connect to OpenRouter API: {e}")
+        raise ValueError(f"LLM backend '{backend.name}' rejected the request: {e}")
     except Exception as e:
+        # Only transport errors and timeouts (UpstreamUnavailable) open the breaker
+        backend.breaker.release()
         print(f"Unexpected error: {e}")
-        raise ValueError(f"Unexpected error while getting LLM response: {e}")
\ No newline at end of file
+        raise ValueError(f"Unexpected error while getting LLM response: {e}")
+
+    backend.breaker.record_success()
+    prompt_cache_stats.record(uuid, response_data.get("usage"))
+    if backend.is_llamacpp and digest:
+        backend.kv_slots.mark_resident(backend.kv_slots.slot_for(digest), digest)
+
+    if response_data and "choices" in response_data and response_data["choices"]:
+        return response_data["choices"][0]["message"]["content"]
+    else:
+        print(f"No valid response: {response_data}")
+        return "No response from LLM."
+
+
+def _route(context_tokens: int) -> Tuple[Route, List[Backend]]:
+    route = llm_router.route_for(context_tokens)
+    backends = route.candidates(context_tokens)
+    if not backends:
+        raise ValueError(f"No LLM backend accepts a context of {context_tokens} tokens")
+    return route, backends
+
+
+async def _complete(build: Callable[[Backend], dict], context_tokens: int,
+                    uuid: Optional[str] = None, digest: Optional[str] = None) -> str:
+    # Tries the route's backends in order, skipping any whose circuit breaker is open. With
+    # hedge_after set, a backend that has not answered in time is raced against the next
+    # one; the first answer wins and the slower copy is cancelled.
+    route, backends = _route(context_tokens)
+    remaining = list(backends)
+    running = {}
+    errors = []
+    hedged = False
+    rejected = False
+
+    def launch() -> Optional[Backend]:
+        nonlocal rejected
+        while remaining:
+            backend = remaining.pop(0)
+            config_error = backend.config_error()
+            if config_error:
+                # A configuration mistake, not an outage: report it and leave the breaker alone
+                errors.append(f"{backend.name}: {config_error}")
+                rejected = True
+                continue
+            if not backend.breaker.allow():
+                errors.append(f"{backend.name}: circuit open")
+                continue
+            task = asyncio.ensure_future(_call_backend(backend, build(backend), uuid, digest))
+            running[task] = backend
+            return backend
+        return None
+
+    try:
+        while True:
+            if not running and launch() is None:
+                break
+            hedge_after = route.hedge_after if not hedged and remaining else None
+            done, _ = await asyncio.wait(running, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                backend = launch()
+                if backend is not None:
+                    upstream_hedges.inc(backend=backend.name)
+                continue
+            for task in done:
+                backend = running.pop(task)
+                try:
+                    return task.result()
+                except ValueError as e:
+                    errors.append(f"{backend.name}: {e}")
+                    rejected = rejected or not isinstance(e, UpstreamUnavailable)
+                    if remaining or running:
+                        print(f"LLM backend '{backend.name}' failed, trying the next one ({e})")
+                        upstream_failovers.inc(backend=backend.name)
+    finally:
+        for task in running:
+            task.cancel()
+
+    # Unavailable only when no backend answered at all, so callers can ask clients to retry later
+    raise (ValueError if rejected else UpstreamUnavailable)(f"All LLM backends failed: {'; '.join(errors)}")
+
+
+async def get_llm_responce(context: str, query: str, uuid: Optional[str] = None, digest: Optional[str] = None,
+                           context_tokens: Optional[int] = None) -> str:
+    if context_tokens is None:
+        context_tokens = count_tokens(context)
+    return await _complete(lambda backend: _build_payload(backend, context, query, digest=digest), context_tokens, uuid, digest)
+
+
+def build_batch_query(queries: List[str]) -> str:
+    numbered = "\n".join(f"{number}. {query}" for number, query in enumerate(queries, 1))
+    return (
+        f"Answer each of the following {len(queries)} questions separately, using only the document.\n"
+        f"{numbered}\n\n"
+        'Reply with a JSON object of the form {"answers": ["answer to question 1", ...]} '
+        f"containing exactly {len(queries)} strings, in question order."
+    )
+
+
+def parse_batch_answers(content: str, expected: int) -> Optional[List[str]]:
+    # Some models wrap JSON in a code fence even in JSON mode
+    content = content.strip().removeprefix("```json").strip("`").strip()
+    try:
+        answers = json.loads(content).get("answers")
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(answers, list) or len(answers) != expected:
+        return None
+    return [answer if isinstance(answer, str) else json.dumps(answer) for answer in answers]
+
+
+async def get_llm_batch_responce(context: str, queries: List[str], uuid: Optional[str] = None,
+                                 digest: Optional[str] = None, context_tokens: Optional[int] = None) -> Optional[List[str]]:
+    # Several questions in one completion over the same document prefix. Returns None
+    # when the model does not return one answer per question.
+    batch_query = build_batch_query(queries)
+
+    def build(backend: Backend) -> dict:
+        payload = _build_payload(backend, context, batch_query, digest=digest)
+        payload["max_tokens"] = min(backend.max_tokens * len(queries), BATCH_PACK_MAX_TOKENS)
+        payload["response_format"] = {"type": "json_object"}
+        return payload
+
+    if context_tokens is None:
+        context_tokens = count_tokens(context)
+    return parse_batch_answers(await _complete(build, context_tokens, uuid, digest), len(queries))
+
+
+async def stream_llm_responce(context: str, query: str, uuid: Optional[str] = None, digest: Optional[str] = None,
+                              context_tokens: Optional[int] = None) -> AsyncIterator[str]:
+    # Yields content deltas from the provider's SSE stream as they arrive. Fails over to the
+    # next backend only until the first token; streams are not hedged.
+    if context_tokens is None:
+        context_tokens = count_tokens(context)
+    _, backends = _route(context_tokens)
+    errors = []
+    rejected = False
+
+    for backend in backends:
+        config_error = backend.config_error()
+        if config_error:
+            errors.append(f"{backend.name}: {config_error}")
+            rejected = True
+            continue
+        if not backend.breaker.allow():
+            errors.append(f"{backend.name}: circuit open")
+            continue
+        payload = _build_payload(backend, context, query, stream=True, digest=digest)
+        semaphore = _get_semaphore()
+        try:
+            if backend.is_llamacpp and digest:
+                await _ensure_kv_resident(backend, digest)
+            await semaphore.acquire()
+        except BaseException:
+            # Cancelled before the request went out (e.g. the client disconnected); frees a half-open trial
+            backend.breaker.release()
+            raise
+
+        try:
+            started = time.perf_counter()
+            try:
+                response = await _send_with_retries(backend, payload, stream=True)
+            except UpstreamUnavailable as e:
+                backend.breaker.record_failure()
+                errors.append(f"{backend.name}: {e}")
+                if backend is not backends[-1]:
+                    upstream_failovers.inc(backend=backend.name)
+                continue
+            except httpx.HTTPError as e:
+                backend.breaker.record_success()
+                print(f"Request error: {e}")
+                rejected = True
+                errors.append(f"{backend.name}: {e}")
+                if backend is not backends[-1]:
+                    upstream_failovers.inc(backend=backend.name)
+                continue
+            except BaseException:
+                backend.breaker.release()
+                raise
+
+            yielded = False
+            try:
+                async for line in response.aiter_lines():
+                    # Skip blank separators and SSE comments (OpenRouter sends keep-alive comments)
+                    if not line or line.startswith(":") or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except json.JSONDecodeError:
+                        print(f"Skipping malformed stream chunk: {data[:200]}")
+                        continue
+                    if "error" in chunk:
+                        raise ValueError(f"LLM backend '{backend.name}' stream error: {chunk['error']}")
+                    if chunk.get("usage"):
+                        prompt_cache_stats.record(uuid, chunk["usage"])
+                    choices = chunk.get("choices") or []
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yielded = True
+                            yield delta
+            except (ValueError, httpx.HTTPError) as e:
+                backend.breaker.record_failure()
+                if yielded:
+                    print(f"Stream error: {e}")
+                    raise ValueError(f"LLM backend '{backend.name}' stream interrupted: {e}")
+                errors.append(f"{backend.name}: {e}")
+                if backend is not backends[-1]:
+                    upstream_failovers.inc(backend=backend.name)
+                continue
+            except BaseException:
+                backend.breaker.release()
+                raise
+            finally:
+                await response.aclose()
+                stage_seconds.observe(time.perf_counter() - started, stage="upstream_total")
+            backend.breaker.record_success()
+            return
+        finally:
+            semaphore.release()
+
+    # Unavailable only when no backend answered at all, so callers can ask clients to retry later
+    raise (ValueError if rejected else UpstreamUnavailable)(f"All LLM backends failed: {'; '.join(errors)}")
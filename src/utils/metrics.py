@@ -0,0 +1,162 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Prometheus text-format metrics without the client library.
+# Counters and histograms are updated where the work happens; point-in-time
+# values (cache sizes, queue depth, ...) are read by collectors at scrape time.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Sample = Tuple[Dict[str, str], float]
+Family = Tuple[str, str, str, List[Sample]]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(dict(key))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                labels = dict(key)
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=_format_value(bound)))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le='+Inf'))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._blocking_collectors = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], List[Family]], blocking: bool = False) -> None:
+        # collector() returns [(name, type, help, [(labels, value), ...]), ...]. Blocking
+        # collectors (ones that do I/O) are run separately by collect_blocking(), off the event loop.
+        (self._blocking_collectors if blocking else self._collectors).append(collector)
+
+    def _collect(self, collectors: List[Callable[[], List[Family]]]) -> List[Family]:
+        families = []
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                print(f"Metrics collector {collector.__name__} failed: {e}")
+        return families
+
+    def collect_blocking(self) -> List[Family]:
+        return self._collect(self._blocking_collectors)
+
+    def render(self, blocking_families: List[Family] = None) -> str:
+        # blocking_families: collect_blocking()'s result; blocking collectors are skipped without it
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        families = self._collect(self._collectors) + (blocking_families or [])
+        for name, metric_type, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# Per-stage latency, recorded where each stage runs
+http_request_seconds = metrics.histogram(
+    "cag_http_request_seconds", "Total time to handle an HTTP request, by route"
+)
+stage_seconds = metrics.histogram(
+    "cag_stage_seconds",
+    "Time spent per processing stage (upload_write, store_read, prompt_build, upstream_ttfb, upstream_total)",
+)
+pdf_page_seconds = metrics.histogram(
+    "cag_pdf_extract_page_seconds", "pypdf text extraction time per page",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+upstream_requests = metrics.counter(
+    "cag_llm_requests_total", "Upstream chat-completion requests, by backend and outcome"
+)
+upstream_failovers = metrics.counter(
+    "cag_llm_failovers_total", "LLM requests moved to the next backend after one failed, by failed backend"
+)
+upstream_hedges = metrics.counter(
+    "cag_llm_hedged_requests_total", "Second copies of slow LLM requests sent to another backend, by hedge backend"
+)
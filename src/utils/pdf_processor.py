@@ -1,18 +1,228 @@
-from pypdf import PdfReader 
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple
 
-def extract_text_from_pdf(pdf_path:str) -> str:
+if TYPE_CHECKING:
+    from pypdf import PdfReader
+
+from src.utils.artifacts import build_outline, join_pages
+from src.utils.compression import COMPRESS_CONTEXT, compress_page_texts
+from src.utils.metrics import pdf_page_seconds
+
+# Extraction settings. Large PDFs are split into page ranges that run in a
+# process pool (pypdf is pure Python, so threads would serialise on the GIL).
+# A thread cannot be stopped mid-page, so while the timeout is on every PDF goes
+# through the pool, where a stuck worker can be killed; with the timeout off,
+# small PDFs are extracted inline to avoid the IPC overhead.
+PDF_WORKERS = int(os.environ.get("CAG_PDF_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = int(os.environ.get("CAG_PDF_PAGES_PER_TASK", "25"))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("CAG_PDF_PARALLEL_MIN_PAGES", "50"))
+PDF_EXTRACT_TIMEOUT = float(os.environ.get("CAG_PDF_EXTRACT_TIMEOUT", "300"))  # 0 disables it
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()  # ingestion runs on several threads
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the server process holds threads, locks and sqlite connections
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, PDF_WORKERS), mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def shutdown_pool(pool: Optional[ProcessPoolExecutor] = None, terminate: bool = False) -> None:
+    # With pool given, only that pool is shut down; another job may already have replaced it.
+    # terminate stops the workers too: shutdown() alone lets a worker stuck on a page run on.
+    global _pool
+    with _pool_lock:
+        if _pool is None or (pool is not None and pool is not _pool):
+            return
+        current, _pool = _pool, None
+    if terminate:
+        for process in list((current._processes or {}).values()):
+            process.terminate()
+    current.shutdown(wait=False, cancel_futures=True)
+
+
+@contextmanager
+def _open_pdf(pdf_path: str) -> Iterator["PdfReader"]:
+    # PdfReader(path) copies the whole file into a BytesIO; reading through a
+    # read-only mmap lets the OS page it in on demand and share it between workers.
+    # pypdf is imported here so the server starts without it until the first upload.
+    from pypdf import PdfReader
+
+    with open(pdf_path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            yield PdfReader(fh)
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield PdfReader(mapped)
+
+
+def _extract_pages(reader: "PdfReader", start: int, stop: int) -> List[Tuple[int, str, Optional[str], float]]:
+    # One bad page must not take down the rest. Timings travel back with the text
+    # because worker processes cannot update this process's metrics.
+    results = []
+    for page_number in range(start, stop):
+        started = time.perf_counter()
+        try:
+            text = reader.pages[page_number].extract_text() or ""
+            results.append((page_number, text, None, time.perf_counter() - started))
+        except Exception as e:
+            results.append((page_number, "", str(e), time.perf_counter() - started))
+    return results
+
+
+def _extract_page_range(pdf_path: str, start: int, stop: int) -> List[Tuple[int, str, Optional[str], float]]:
+    # Runs in a worker process
+    with _open_pdf(pdf_path) as reader:
+        return _extract_pages(reader, start, stop)
+
+
+def _read_bookmarks(reader: "PdfReader") -> List[dict]:
+    # The PDF's outline (bookmarks) as a flat list with 0-based pages; empty when absent or unreadable
+    bookmarks = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):
+                walk(item, level + 1)
+                continue
+            try:
+                page = reader.get_destination_page_number(item)
+            except Exception:
+                continue
+            if page is not None and page >= 0 and item.title:
+                bookmarks.append({"title": item.title.strip(), "page": page, "level": level})
+
+    try:
+        walk(reader.outline, 1)
+    except Exception as e:
+        print(f"Could not read the outline of the PDF: {e}")
+    return bookmarks
+
+
+def read_bookmarks(pdf_path: str) -> List[dict]:
+    with _open_pdf(pdf_path) as reader:
+        return _read_bookmarks(reader)
+
+
+def _extract_in_pool(pdf_path: str, ranges: List[Tuple[int, int]], timeout: float,
+                     range_done: Callable[[int, int], None]) -> Optional[list]:
+    # Returns None once the deadline passes, after killing the workers still on this PDF
+    deadline = time.monotonic() + timeout if timeout > 0 else None
+    results = []
+    retry = True
+    while ranges:
+        pool = _get_pool()
+        futures = []
+        for start, stop in ranges:
+            try:
+                futures.append(pool.submit(_extract_page_range, pdf_path, start, stop))
+            except (BrokenProcessPool, RuntimeError):
+                futures.append(None)  # The pool was shut down under us
+        broken = []
+        for (start, stop), future in zip(ranges, futures):
+            try:
+                if future is None:
+                    raise BrokenProcessPool("Extraction pool was shut down")
+                remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+                results.extend(future.result(timeout=remaining))
+            except FutureTimeoutError:
+                shutdown_pool(pool, terminate=True)
+                print(f"Error: Extraction of {pdf_path} exceeded {timeout}s")
+                return None
+            except (BrokenProcessPool, CancelledError) as e:
+                # A worker died, or another PDF's timeout killed the pool: retry once on a new pool
+                shutdown_pool(pool)
+                if retry:
+                    broken.append((start, stop))
+                    continue
+                print(f"Error extracting pages {start + 1}-{stop} of {pdf_path}: {e or 'worker pool was shut down'}")
+            except Exception as e:
+                # The whole range failed; keep the other ranges
+                print(f"Error extracting pages {start + 1}-{stop} of {pdf_path}: {e}")
+            range_done(start, stop)
+        ranges, retry = broken, False
+    return results
+
+
+def extract_pages_from_pdf(pdf_path: str, timeout: float = PDF_EXTRACT_TIMEOUT,
+                           progress: Optional[Callable[[int, int], None]] = None) -> Optional[List[str]]:
+    # Text of every page in page order; failed pages come back empty, and None means the
+    # timeout passed. progress(pages_done, page_count) is called as page ranges complete.
+    with _open_pdf(pdf_path) as reader:
+        page_count = len(reader.pages)
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    pages_done = 0
+    if progress:
+        progress(0, page_count)
+
+    def range_done(start: int, stop: int) -> None:
+        nonlocal pages_done
+        pages_done += stop - start
+        if progress:
+            progress(pages_done, page_count)
+
+    if timeout <= 0 and (PDF_WORKERS <= 1 or page_count < PDF_PARALLEL_MIN_PAGES):
+        results = []
+        with _open_pdf(pdf_path) as reader:
+            for start, stop in ranges:
+                results.extend(_extract_pages(reader, start, stop))
+                range_done(start, stop)
+    else:
+        results = _extract_in_pool(pdf_path, ranges, timeout, range_done)
+        if results is None:
+            return None
+
+    pages = [""] * page_count
+    extracted = 0
+    for page_number, text, error, seconds in results:
+        pdf_page_seconds.observe(seconds)
+        if error:
+            print(f"Error extracting page {page_number + 1} of {pdf_path}: {error}")
+        else:
+            extracted += 1
+        pages[page_number] = text
+    if page_count and not extracted:
+        # Isolating page errors must not turn an unreadable document into an empty one
+        raise ValueError(f"None of the {page_count} pages of the PDF could be extracted")
+    return pages
+
+
+def extract_document_from_pdf(pdf_path: str, progress: Optional[Callable[[int, int], None]] = None) -> Tuple[Optional[str], dict]:
+    # Stored text plus its artifacts: where each page starts in the text and the outline.
+    # Returns (None, {}) on timeout and raises ValueError when the PDF cannot be read,
+    # so a broken upload fails its job instead of storing a placeholder.
     try:
-        reader=PdfReader(pdf_path)
-        full_text=[]
-
-        for page in reader.pages:
-            text=page.extract_text()
-            if text:
-                full_text.append(text)
-        return "\n".join(full_text)
+        pages = extract_pages_from_pdf(pdf_path, progress=progress)
+        if pages is None:
+            return None, {}
+        if COMPRESS_CONTEXT:
+            pages = compress_page_texts(pages)
+            text, offsets = join_pages(pages, "\n\n")
+        else:
+            text, offsets = join_pages(pages)
+        return text, {"pages": offsets, "outline": build_outline(pages, read_bookmarks(pdf_path))}
     except FileNotFoundError:
         print(f"Error: File not found at {pdf_path}")
-        return " "
+        raise ValueError("Uploaded PDF file is missing.")
+    except ValueError:
+        raise
     except Exception as e:
         print(f"An error Occurred while extracting text:{e} ")
-        return " " 
\ No newline at end of file
+        raise ValueError(f"Could not read the PDF: {e}")
+
+
+def extract_text_from_pdf(pdf_path:str, progress: Optional[Callable[[int, int], None]] = None) -> Optional[str]:
+    return extract_document_from_pdf(pdf_path, progress)[0]
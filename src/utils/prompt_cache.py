@@ -0,0 +1,100 @@
+import threading
+from typing import Optional
+
+# Bookkeeping for provider-side prompt (KV prefix) caching.
+# Hosted providers report how much of the prompt was served from their cache
+# in the response usage; we aggregate that per document UUID. For a local
+# llama.cpp server we also remember which document prefix each slot holds and
+# which documents have a saved KV cache on the server's disk.
+
+
+def cached_tokens_from_usage(usage: Optional[dict]) -> int:
+    if not usage:
+        return 0
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens")
+    if cached is None:
+        # Anthropic-style field names, passed through by some providers
+        cached = usage.get("cache_read_input_tokens", 0)
+    return int(cached or 0)
+
+
+class PromptCacheStats:
+    def __init__(self):
+        self._by_uuid = {}
+        self._totals = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+
+    def record(self, uuid: Optional[str], usage: Optional[dict]) -> None:
+        if not usage:
+            return
+        prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        cached = cached_tokens_from_usage(usage)
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+        with self._lock:
+            # Totals include calls that are not tied to one document (e.g. cross-document answers)
+            self._totals["requests"] += 1
+            self._totals["prompt_tokens"] += prompt_tokens
+            self._totals["cached_tokens"] += cached
+            self._totals["completion_tokens"] += completion_tokens
+            if uuid is None:
+                return
+            entry = self._by_uuid.setdefault(
+                uuid, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+            )
+            entry["requests"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["cached_tokens"] += cached
+            entry["completion_tokens"] += completion_tokens
+
+    def totals(self) -> dict:
+        with self._lock:
+            return dict(self._totals)
+
+    def forget(self, uuid: str) -> None:
+        with self._lock:
+            self._by_uuid.pop(uuid, None)
+
+    def stats(self, uuid: Optional[str] = None) -> dict:
+        with self._lock:
+            entries = {uuid: self._by_uuid.get(uuid)} if uuid else dict(self._by_uuid)
+            result = {}
+            for key, entry in entries.items():
+                if entry is None:
+                    continue
+                ratio = entry["cached_tokens"] / entry["prompt_tokens"] if entry["prompt_tokens"] else 0.0
+                result[key] = dict(entry, cached_ratio=ratio)
+            return result
+
+
+class KVSlotRegistry:
+    # Tracks llama.cpp server slots: which digest is resident and which have been saved to disk
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self._resident = {}  # slot -> digest
+        self._saved = set()
+        self._lock = threading.Lock()
+
+    def slot_for(self, digest: str) -> int:
+        # Stable slot assignment so the same document keeps landing on the same slot
+        return int(digest[:8], 16) % self.slots
+
+    def is_resident(self, slot: int, digest: str) -> bool:
+        with self._lock:
+            return self._resident.get(slot) == digest
+
+    def mark_resident(self, slot: int, digest: str) -> None:
+        with self._lock:
+            self._resident[slot] = digest
+
+    def is_saved(self, digest: str) -> bool:
+        with self._lock:
+            return digest in self._saved
+
+    def mark_saved(self, digest: str) -> None:
+        with self._lock:
+            self._saved.add(digest)
+
+
+prompt_cache_stats = PromptCacheStats()
@@ -0,0 +1,264 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+from src.utils.tokens import count_tokens
+
+# Chunked retrieval for documents too large to send whole.
+# Each segment of a document is split into overlapping chunks and indexed with
+# BM25; at query time the best chunks that fit the token budget are sent, in
+# document order.
+
+RETRIEVAL_CHUNK_TOKENS = int(os.environ.get("CAG_RETRIEVAL_CHUNK_TOKENS", "400"))
+RETRIEVAL_CHUNK_OVERLAP = int(os.environ.get("CAG_RETRIEVAL_CHUNK_OVERLAP", "50"))
+RETRIEVAL_TOP_K = int(os.environ.get("CAG_RETRIEVAL_TOP_K", "8"))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("CAG_RETRIEVAL_TOKEN_BUDGET", "6000"))
+# In "auto" mode documents above this size use retrieval, smaller ones are sent whole
+FULL_CONTEXT_MAX_TOKENS = int(os.environ.get("CAG_FULL_CONTEXT_MAX_TOKENS", "12000"))
+
+CHUNK_SEPARATOR = "\n\n[...]\n\n"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall(text.casefold())
+
+
+def split_into_chunks(text: str, chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS, overlap: int = RETRIEVAL_CHUNK_OVERLAP) -> List[str]:
+    # Pack whole paragraphs into chunks; paragraphs longer than a chunk are cut on word boundaries
+    words_per_chunk = max(1, int(chunk_tokens * 0.75))
+    overlap_words = min(max(0, int(overlap * 0.75)), words_per_chunk - 1)
+
+    chunks = []
+    current = []
+    current_words = 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        words = paragraph.split()
+        if not words:
+            continue
+        if len(words) > words_per_chunk:
+            if current:
+                chunks.append("\n\n".join(current))
+                current, current_words = [], 0
+            step = words_per_chunk - overlap_words
+            for start in range(0, len(words), step):
+                chunks.append(" ".join(words[start:start + words_per_chunk]))
+                if start + words_per_chunk >= len(words):
+                    break
+            continue
+        if current_words + len(words) > words_per_chunk and current:
+            chunks.append("\n\n".join(current))
+            current, current_words = [], 0
+        current.append(paragraph.strip())
+        current_words += len(words)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+class SegmentIndex:
+    # Chunks and postings for one segment (one stored blob). Shared between
+    # documents that contain the same blob and never rebuilt once created.
+
+    def __init__(self, text: str):
+        self.chunks = split_into_chunks(text)
+        self.token_counts = [count_tokens(chunk) for chunk in self.chunks]
+        # Approximate start of each chunk in the text (chunking normalizes whitespace),
+        # enough to tell which page a chunk comes from
+        self.offsets = []
+        cursor = 0
+        for chunk in self.chunks:
+            found = text.find(chunk.split(None, 1)[0], cursor)
+            cursor = found if found >= 0 else cursor
+            self.offsets.append(cursor)
+        self.postings = {}  # term -> [(chunk index, term frequency)]
+        self.lengths = []
+        for index, chunk in enumerate(self.chunks):
+            terms = tokenize(chunk)
+            self.lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self.postings.setdefault(term, []).append((index, tf))
+
+
+class DocumentIndex:
+    # BM25 over the chunks of all segments of a document. Collection statistics
+    # (document frequency, average length) are combined at query time, so adding
+    # a segment only requires indexing that segment.
+
+    def __init__(self, segments: List[Tuple[str, SegmentIndex]], k1: float = 1.5, b: float = 0.75):
+        self.segments = segments
+        self.k1 = k1
+        self.b = b
+        self._chunk_count = sum(len(index.chunks) for _, index in segments)
+        total_length = sum(sum(index.lengths) for _, index in segments)
+        self._avg_length = (total_length / self._chunk_count) if self._chunk_count else 0.0
+
+    def _idf(self, term: str) -> float:
+        df = sum(len(index.postings.get(term, ())) for _, index in self.segments)
+        return math.log(1 + (self._chunk_count - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> List[Tuple[Tuple[int, int], float]]:
+        # Scores keyed by (segment position, chunk index)
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = None
+            for position, (_, index) in enumerate(self.segments):
+                postings = index.postings.get(term)
+                if not postings:
+                    continue
+                if idf is None:
+                    idf = self._idf(term)
+                for chunk, tf in postings:
+                    norm = self.k1 * (1 - self.b + self.b * index.lengths[chunk] / (self._avg_length or 1))
+                    key = (position, chunk)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def chunk_tokens(self, key: Tuple[int, int]) -> int:
+        return self.segments[key[0]][1].token_counts[key[1]]
+
+    def select(self, query: str, token_budget: int = RETRIEVAL_TOKEN_BUDGET, top_k: int = RETRIEVAL_TOP_K) -> List[Tuple[int, int]]:
+        # Best-scoring chunks that fit the budget, returned in document order
+        selected = []
+        used = 0
+        for key, _ in self.search(query, top_k):
+            if used + self.chunk_tokens(key) > token_budget:
+                continue
+            selected.append(key)
+            used += self.chunk_tokens(key)
+        if not selected:
+            # Nothing matched the query terms; fall back to the start of the document
+            for position, (_, index) in enumerate(self.segments):
+                for chunk, tokens in enumerate(index.token_counts):
+                    if used + tokens > token_budget:
+                        return selected
+                    selected.append((position, chunk))
+                    used += tokens
+        return sorted(selected)
+
+    def chunk_text(self, key: Tuple[int, int]) -> str:
+        return self.segments[key[0]][1].chunks[key[1]]
+
+    def chunk_offset(self, key: Tuple[int, int]) -> Tuple[str, int]:
+        # (blob, approximate character offset in the blob)
+        return self.segments[key[0]][0], self.segments[key[0]][1].offsets[key[1]]
+
+    def chunk_id(self, key: Tuple[int, int]) -> str:
+        # Content-addressed: stays the same when other segments change
+        return f"{self.segments[key[0]][0]}:{key[1]}"
+
+
+class RetrievalIndexes:
+    # Segment indexes keyed by blob, so identical content is indexed once no matter
+    # how many UUIDs or segments refer to it
+
+    def __init__(self):
+        self._segments = {}  # blob -> SegmentIndex
+        self._blobs_by_uuid = {}
+        self._lock = threading.Lock()
+
+    def _release(self, uuid: str, keep: List[str] = ()) -> None:
+        # Caller must hold the lock
+        blobs = self._blobs_by_uuid.pop(uuid, [])
+        still_used = set(keep)
+        for other in self._blobs_by_uuid.values():
+            still_used.update(other)
+        for blob in blobs:
+            if blob not in still_used:
+                self._segments.pop(blob, None)
+
+    def sync(self, uuid: str, blobs: List[str], load_blob: Callable[[str], Optional[str]]) -> Optional[DocumentIndex]:
+        # Index only the segments not seen before; also picks up changes made by other workers
+        with self._lock:
+            missing = [blob for blob in blobs if blob not in self._segments]
+        built = {}
+        for blob in missing:
+            text = load_blob(blob)
+            if text is None:
+                return None
+            built[blob] = SegmentIndex(text)
+        with self._lock:
+            for blob, index in built.items():
+                self._segments.setdefault(blob, index)
+            if self._blobs_by_uuid.get(uuid) != blobs:
+                self._release(uuid, keep=blobs)
+                self._blobs_by_uuid[uuid] = list(blobs)
+            return DocumentIndex([(blob, self._segments[blob]) for blob in blobs])
+
+    def drop(self, uuid: str) -> None:
+        with self._lock:
+            self._release(uuid)
+
+    def select_context(self, uuid: str, blobs: List[str], load_blob: Callable[[str], Optional[str]], query: str,
+                       token_budget: int = RETRIEVAL_TOKEN_BUDGET, top_k: int = RETRIEVAL_TOP_K,
+                       chunk_label: Optional[Callable[[str, int], str]] = None) -> Optional[Tuple[str, str, int]]:
+        # Returns the context, a digest of the selected chunks and their token count;
+        # the digest only changes when the selected content does. chunk_label(blob, offset)
+        # returns a line to put before each chunk, e.g. its page.
+        index = self.sync(uuid, blobs, load_blob)
+        if index is None:
+            return None
+        selected = index.select(query, token_budget, top_k)
+        tokens = sum(index.chunk_tokens(key) for key in selected)
+        if chunk_label is not None:
+            # Labels are part of what is sent (and can shift when an earlier segment is
+            # replaced), so they are part of the digest too
+            labels = [chunk_label(*index.chunk_offset(key)) for key in selected]
+            texts = [f"{label}\n{index.chunk_text(key)}" for label, key in zip(labels, selected)]
+            ids = [f"{index.chunk_id(key)}\x1f{label}" for label, key in zip(labels, selected)]
+        else:
+            texts = [index.chunk_text(key) for key in selected]
+            ids = [index.chunk_id(key) for key in selected]
+        selection_digest = hashlib.sha256("\n".join(ids).encode("utf-8")).hexdigest()
+        return CHUNK_SEPARATOR.join(texts), selection_digest, tokens
+
+    def select_across(self, documents: List[Tuple[str, List[str]]], load_blob: Callable[[str], Optional[str]], query: str,
+                      token_budget: int = RETRIEVAL_TOKEN_BUDGET,
+                      top_k: int = RETRIEVAL_TOP_K) -> List[Tuple[str, str, str, int]]:
+        # Best chunks across several documents (each searched through its own index) that
+        # fit one budget. Returns (uuid, context, selection digest, tokens) per document
+        # that contributed, in the order the documents were given.
+        indexes = {}
+        candidates = []
+        for uuid, blobs in documents:
+            index = self.sync(uuid, blobs, load_blob)
+            if index is None:
+                continue
+            indexes[uuid] = index
+            candidates.extend((score, uuid, key) for key, score in index.search(query, top_k))
+
+        selected = {}
+        used = 0
+        for _, uuid, key in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+            tokens = indexes[uuid].chunk_tokens(key)
+            if used + tokens > token_budget:
+                continue
+            selected.setdefault(uuid, []).append(key)
+            used += tokens
+        if not selected and indexes:
+            # Nothing matched the query terms; give every document an equal share of its start
+            share = max(1, token_budget // len(indexes))
+            selected = {uuid: index.select("", share, top_k) for uuid, index in indexes.items()}
+
+        results = []
+        for uuid, _ in documents:
+            keys = sorted(selected.get(uuid, ()))
+            if not keys:
+                continue
+            index = indexes[uuid]
+            selection_digest = hashlib.sha256("\n".join(index.chunk_id(key) for key in keys).encode("utf-8")).hexdigest()
+            results.append((
+                uuid,
+                CHUNK_SEPARATOR.join(index.chunk_text(key) for key in keys),
+                selection_digest,
+                sum(index.chunk_tokens(key) for key in keys),
+            ))
+        return results
+
+
+retrieval_indexes = RetrievalIndexes()
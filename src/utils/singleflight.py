@@ -0,0 +1,87 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Tuple, TypeVar
+
+# Single-flight call deduplication.
+# Concurrent callers with the same key share one in-flight call instead of
+# each making their own. The call runs as its own task, so a caller that goes
+# away (client disconnect, deadline) does not cancel it for the others still
+# waiting; when the last waiter goes away the call is cancelled, so abandoned
+# calls do not keep holding upstream concurrency.
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self):
+        self._in_flight = {}  # key -> asyncio.Task
+        self._waiters = {}  # asyncio.Task -> callers still waiting for it
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def start(self, key: str, call: Callable[[], Awaitable[T]]) -> Tuple[asyncio.Task, bool]:
+        # Joins the in-flight call for key or starts one, and returns it and whether it was
+        # shared. The caller is now one of its waiters: follow with wait() or leave().
+        with self._lock:
+            task = self._in_flight.get(key)
+            shared = task is not None
+            if shared:
+                self.coalesced += 1
+            else:
+                task = asyncio.ensure_future(call())
+                self._in_flight[key] = task
+                self._waiters[task] = 0
+                self.calls += 1
+                task.add_done_callback(lambda done, key=key: self._forget(key, done))
+            self._waiters[task] += 1
+        return task, shared
+
+    async def wait(self, task: asyncio.Task) -> T:
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.leave(task)
+
+    def leave(self, task: asyncio.Task) -> None:
+        with self._lock:
+            if task not in self._waiters:
+                return
+            self._waiters[task] -= 1
+            if self._waiters[task] > 0 or task.done():
+                return
+            # Nobody wants the answer any more; later callers start a fresh call
+            del self._waiters[task]
+            for key, in_flight in list(self._in_flight.items()):
+                if in_flight is task:
+                    del self._in_flight[key]
+            self.abandoned += 1
+        task.cancel()
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        # Returns the result and whether it came from another caller's call
+        task, shared = self.start(key, call)
+        return await self.wait(task), shared
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+            self._waiters.pop(task, None)
+        if not task.cancelled():
+            task.exception()  # Mark retrieved so an unawaited failure is not logged as lost
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.calls + self.coalesced
+            return {
+                "in_flight": len(self._in_flight),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "abandoned": self.abandoned,
+                "coalesced_ratio": (self.coalesced / requests) if requests else 0.0,
+            }
+
+
+llm_calls = SingleFlight()
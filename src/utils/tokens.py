@@ -0,0 +1,69 @@
+import os
+from typing import Optional
+
+# Token counting and context budgets.
+# tiktoken is used when it is installed; otherwise counts fall back to the
+# four-characters-per-token estimate. Documents are counted once at ingestion
+# and the count is stored with the document, so queries never re-count them.
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKENIZER_ENCODING = os.environ.get("CAG_TOKENIZER_ENCODING", "o200k_base")
+
+# Context window per model prefix; the first matching prefix wins
+MODEL_CONTEXT_LIMITS = (
+    ("openai/gpt-5", 400000),
+    ("openai/gpt-4.1", 1047576),
+    ("openai/gpt-4o", 128000),
+    ("anthropic/claude", 200000),
+    ("google/gemini", 1048576),
+    ("meta-llama/", 131072),
+)
+DEFAULT_CONTEXT_LIMIT = 128000
+# Overrides the table above, e.g. for a local server with a smaller n_ctx
+MODEL_CONTEXT_LIMIT = int(os.environ.get("CAG_MODEL_CONTEXT_LIMIT", "0"))
+# Tokens kept free for chat framing and tokenizer mismatch with the provider
+CONTEXT_RESERVE_TOKENS = int(os.environ.get("CAG_CONTEXT_RESERVE_TOKENS", "256"))
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            # Unknown encoding or no network to fetch it; stay on the estimate
+            print(f"Tokenizer {TOKENIZER_ENCODING} unavailable, estimating token counts: {e}")
+            _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: Optional[str]) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Roughly four characters per token for English text
+    return max(1, len(text) // 4)
+
+
+def context_limit(model: str) -> int:
+    if MODEL_CONTEXT_LIMIT > 0:
+        return MODEL_CONTEXT_LIMIT
+    for prefix, limit in MODEL_CONTEXT_LIMITS:
+        if model.startswith(prefix):
+            return limit
+    return DEFAULT_CONTEXT_LIMIT
+
+
+def context_budget(window: int, max_tokens: int, *prompt_parts: str) -> int:
+    # Tokens of a `window`-token context left for the document once the completion and
+    # the rest of the prompt are paid for
+    used = max_tokens + CONTEXT_RESERVE_TOKENS + sum(count_tokens(part) for part in prompt_parts)
+    return max(0, window - used)
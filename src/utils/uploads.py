@@ -0,0 +1,140 @@
+import hashlib
+import os
+from typing import AsyncIterator, Optional
+
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+# Streaming multipart upload receiver.
+# The request body is parsed as it arrives and the file part is written straight
+# to its destination, hashed and size-checked chunk by chunk, instead of being
+# spooled to a temporary file by the form parser and then copied again. An upload
+# over the limit is rejected as soon as it crosses it, before the rest is read.
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("CAG_MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# Room for the multipart boundaries, part headers and any small form fields
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+class UnsupportedFileType(InvalidUpload):
+    pass
+
+
+class UploadReceiver:
+    def __init__(self, file_path: str, field: str = "file", content_type: Optional[str] = None,
+                 max_bytes: int = MAX_UPLOAD_BYTES):
+        self.file_path = file_path
+        self.field = field
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.filename = None
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._header_name = b""
+        self._header_value = b""
+        self._headers = {}
+        self._writing = False  # inside the file part we keep
+        self._done = False
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    def on_part_begin(self) -> None:
+        self._headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        # Only the first file in the expected field is kept; other parts are skipped
+        self._writing = not self._done and name == self.field and b"filename" in options
+        if not self._writing:
+            return
+        self.filename = options[b"filename"].decode("utf-8", "replace")
+        content_type = self._headers.get(b"content-type", b"").decode("latin-1").strip()
+        if self.content_type is not None and content_type != self.content_type:
+            raise UnsupportedFileType(f"Unsupported file type {content_type or 'unknown'}")
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self._writing:
+            return
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"File exceeds the {self.max_bytes} byte upload limit")
+        self._buffer += data[start:end]
+
+    def on_part_end(self) -> None:
+        if self._writing:
+            self._writing = False
+            self._done = True
+
+    def _flush(self, out, data: bytes) -> None:
+        self._sha256.update(data)
+        out.write(data)
+
+    async def receive(self, headers, stream: AsyncIterator[bytes]) -> None:
+        # Raises UploadTooLarge, InvalidUpload or whatever reading the stream raises;
+        # the caller removes the partly written file
+        length = headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes + MULTIPART_OVERHEAD:
+            raise UploadTooLarge(f"File exceeds the {self.max_bytes} byte upload limit")
+        _, params = parse_options_header(headers.get("content-type", ""))
+        if b"boundary" not in params:
+            raise InvalidUpload("Expected a multipart/form-data body")
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        body_bytes = 0
+        out = await run_in_threadpool(open, self.file_path, "wb")
+        try:
+            async for chunk in stream:
+                body_bytes += len(chunk)
+                if body_bytes > self.max_bytes + MULTIPART_OVERHEAD:
+                    raise UploadTooLarge(f"File exceeds the {self.max_bytes} byte upload limit")
+                try:
+                    parser.write(chunk)
+                except FormParserError as e:
+                    raise InvalidUpload(f"Invalid multipart body: {e}")
+                # Disk writes and hashing happen off the event loop, a chunk at a time
+                if len(self._buffer) >= UPLOAD_CHUNK_SIZE:
+                    data, self._buffer = bytes(self._buffer), bytearray()
+                    await run_in_threadpool(self._flush, out, data)
+            try:
+                parser.finalize()
+            except FormParserError as e:
+                raise InvalidUpload(f"Invalid multipart body: {e}")
+            if not self._done:
+                raise InvalidUpload(f"Missing file field '{self.field}'")
+            if self._buffer:
+                data, self._buffer = bytes(self._buffer), bytearray()
+                await run_in_threadpool(self._flush, out, data)
+        finally:
+            await run_in_threadpool(out.close)
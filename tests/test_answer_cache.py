@@ -0,0 +1,103 @@
+import uuid as uuid_pkg
+
+import pytest
+
+from src.data_store import DocumentStore, MemoryBackend
+from src.routers import data_handler
+from src.utils.answer_cache import AnswerCache, content_hash
+
+
+def test_invalidate_drops_every_answer_of_a_document():
+    cache = AnswerCache()
+    cache.set("full", "a", "doc", "doc")
+    cache.set("chunks", "b", "selection", "doc")
+    cache.set("other", "c", "other-doc", "other-doc")
+    assert cache.invalidate("doc") == 2
+    assert cache.get("full") is None and cache.get("chunks") is None
+    assert cache.get("other") == "c"
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_answer_across_documents_goes_with_either_document():
+    cache = AnswerCache()
+    cache.set("multi", "a", "combined", "doc-1", "doc-2")
+    assert cache.invalidate("doc-2") == 1
+    assert cache.get("multi") is None
+    assert cache.invalidate("doc-1") == 0
+
+
+def test_transfer_drops_whole_document_answers_and_keeps_the_rest():
+    cache = AnswerCache()
+    cache.set("full", "a", "old", "old")
+    cache.set("chunks", "b", "selection", "old")
+    assert cache.transfer("old", "new") == 1
+    assert cache.get("full") is None
+    assert cache.get("chunks") == "b"
+    # The kept answer now belongs to the new version
+    assert cache.invalidate("old") == 0
+    assert cache.invalidate("new") == 1
+    assert cache.get("chunks") is None
+
+
+def test_transfer_keeps_answers_shared_with_other_documents():
+    cache = AnswerCache()
+    cache.set("multi", "a", "combined", "old", "doc-2")
+    assert cache.transfer("old", "new") == 0
+    assert cache.get("multi") == "a"
+    assert cache.invalidate("new") == 1
+
+
+def test_removed_entries_release_their_bytes():
+    cache = AnswerCache()
+    cache.set("full", "answer", "doc", "doc")
+    cache.transfer("doc", "new")
+    assert cache.stats()["entries"] == 0 and cache.stats()["bytes"] == 0
+
+
+@pytest.fixture
+def router_state(monkeypatch):
+    store = DocumentStore(MemoryBackend())
+    cache = AnswerCache()
+    monkeypatch.setattr(data_handler, "data_store", store)
+    monkeypatch.setattr(data_handler, "answer_cache", cache)
+    monkeypatch.setattr(data_handler, "KV_WARMUP_ENABLED", False)
+    monkeypatch.setattr(data_handler, "DOCUMENT_SUMMARY", False)
+    return store, cache
+
+
+def cache_answers(cache: AnswerCache, digest: str) -> None:
+    # A full-text answer, keyed on the document itself, and a retrieval answer keyed on its chunks
+    cache.set("full", "from the whole document", digest, digest)
+    cache.set("chunks", "from the selected chunks", content_hash("selected chunks"), digest)
+
+
+def test_update_drops_full_text_answers_and_keeps_chunk_answers(router_state):
+    store, cache = router_state
+    uuid_str = str(uuid_pkg.uuid4())
+    store.add(uuid_str, "first part of the document")
+    previous_digest = store.digest(uuid_str)
+    cache_answers(cache, previous_digest)
+
+    store.append(uuid_str, "an appended part")
+    data_handler._after_ingest(uuid_str, None, previous_digest)
+
+    assert cache.get("full") is None
+    assert cache.get("chunks") == "from the selected chunks"
+    data_handler.delete_data(uuid_pkg.UUID(uuid_str))
+    assert cache.get("chunks") is None
+
+
+def test_delete_keeps_answers_while_an_identical_document_remains(router_state):
+    store, cache = router_state
+    first, second = str(uuid_pkg.uuid4()), str(uuid_pkg.uuid4())
+    store.add(first, "the same text")
+    store.add(second, "the same text")
+    digest = store.digest(first)
+    assert store.digest(second) == digest
+    cache_answers(cache, digest)
+
+    data_handler.delete_data(uuid_pkg.UUID(first))
+    assert cache.get("full") == "from the whole document"
+    data_handler.delete_data(uuid_pkg.UUID(second))
+    assert cache.get("full") is None and cache.get("chunks") is None
+    assert cache.stats()["entries"] == 0
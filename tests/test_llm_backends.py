@@ -0,0 +1,87 @@
+from src.utils.llm_backends import Backend, CircuitBreaker, Route, load_router
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.times_opened == 1
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_allows_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()
+
+
+def test_half_open_trial_success_closes():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+
+def test_half_open_trial_failure_reopens():
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0)
+    for _ in range(5):
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.times_opened == 2
+
+
+def test_release_frees_the_trial_without_a_verdict():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open" and breaker.times_opened == 1
+    assert breaker.allow()
+
+
+def test_release_on_a_closed_breaker_changes_nothing():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.release()
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 1, "times_opened": 0}
+
+
+def test_missing_openrouter_key_is_a_config_error(monkeypatch):
+    monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
+    backend = Backend("default", "openai/gpt-5.2")
+    assert "OPENROUTER_API_KEY" in backend.config_error()
+    assert backend.breaker.allow() and backend.breaker.state == "closed"
+    monkeypatch.setenv("OPENROUTER_API_KEY", "sk-test")
+    assert backend.config_error() is None
+
+
+def test_local_backends_never_get_the_openrouter_key(monkeypatch):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "sk-test")
+    backend = Backend("local", "llama", provider="llamacpp")
+    assert backend.config_error() is None
+    assert "Authorization" not in backend.headers()
+
+
+def test_routes_are_chosen_by_context_size():
+    default = Backend("default", "openai/gpt-5.2")
+    router = load_router(default, """{
+        "backends": {"small": {"model": "a"}, "large": {"model": "b"}},
+        "routes": [{"backends": ["large"]}, {"max_context_tokens": 1000, "backends": ["small", "large"]}]
+    }""")
+    assert [backend.name for backend in router.route_for(500).backends] == ["small", "large"]
+    assert [backend.name for backend in router.route_for(5000).backends] == ["large"]
+    assert isinstance(router.route_for(500), Route)
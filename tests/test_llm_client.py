@@ -0,0 +1,204 @@
+import asyncio
+
+import httpx
+import pytest
+
+from src.utils import llm_client
+from src.utils.llm_backends import Backend, BackendRouter, Route, UpstreamUnavailable
+
+
+def make_backend(name: str, **settings) -> Backend:
+    settings.setdefault("provider", "openai")
+    settings.setdefault("api_base", f"http://{name}.test/v1/chat/completions")
+    return Backend(name, "test-model", max_retries=0, timeout=5, **settings)
+
+
+def completion(name: str) -> httpx.Response:
+    return httpx.Response(200, json={"choices": [{"message": {"content": f"answer from {name}"}}]})
+
+
+async def answered(name: str) -> httpx.Response:
+    return completion(name)
+
+
+async def failed(status_code: int) -> httpx.Response:
+    return httpx.Response(status_code, json={"error": {"message": "nope"}})
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # Routes every upstream request to handler(name, request), name being the backend's host
+    requests = []
+
+    def install(handler, route: Route):
+        async def dispatch(request: httpx.Request) -> httpx.Response:
+            name = request.url.host.split(".")[0]
+            requests.append(name)
+            return await handler(name, request)
+
+        monkeypatch.setattr(llm_client, "llm_router", BackendRouter(route.backends, [route]))
+        monkeypatch.setattr(llm_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(dispatch)))
+        monkeypatch.setattr(llm_client, "_semaphore", None)
+        return requests
+
+    return install
+
+
+def ask() -> str:
+    return asyncio.run(llm_client.get_llm_responce("context", "question", context_tokens=10))
+
+
+def trip(backend: Backend) -> None:
+    # Leaves the breaker open with an immediate trial, i.e. half-open on the next allow()
+    backend.breaker.reset_timeout = 0
+    for _ in range(backend.breaker.failure_threshold):
+        backend.breaker.record_failure()
+
+
+def test_hedge_returns_the_first_answer_and_cancels_the_slower_copy(upstream):
+    slow, fast = make_backend("slow"), make_backend("fast")
+    events = []
+
+    async def handler(name, request):
+        if name == "slow":
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                events.append("slow cancelled")
+                raise
+        return completion(name)
+
+    upstream(handler, Route([slow, fast], hedge_after=0.05))
+
+    async def scenario():
+        answer = await llm_client.get_llm_responce("context", "question", context_tokens=10)
+        await asyncio.sleep(0.01)
+        return answer
+
+    assert asyncio.run(scenario()) == "answer from fast"
+    assert events == ["slow cancelled"]
+    # Losing the race says nothing about the slow backend's health
+    assert slow.breaker.stats() == {"state": "closed", "consecutive_failures": 0, "times_opened": 0}
+
+
+def test_hedge_loser_frees_its_half_open_trial(upstream):
+    slow, fast = make_backend("slow"), make_backend("fast")
+    trip(slow)
+
+    async def handler(name, request):
+        if name == "slow":
+            await asyncio.sleep(10)
+        return completion(name)
+
+    upstream(handler, Route([slow, fast], hedge_after=0.05))
+    assert ask() == "answer from fast"
+    assert slow.breaker.state == "half_open"
+    assert slow.breaker.allow()
+
+
+def test_no_hedge_when_the_first_backend_answers_in_time(upstream):
+    requests = upstream(lambda name, request: answered(name), Route([make_backend("a"), make_backend("b")], hedge_after=1))
+    assert ask() == "answer from a"
+    assert requests == ["a"]
+
+
+def test_failover_records_a_failure_on_the_unavailable_backend(upstream):
+    down, up = make_backend("down"), make_backend("up")
+
+    async def handler(name, request):
+        return httpx.Response(503) if name == "down" else completion(name)
+
+    upstream(handler, Route([down, up]))
+    assert ask() == "answer from up"
+    assert down.breaker.failures == 1
+    assert up.breaker.failures == 0
+
+
+def test_open_breaker_skips_the_backend(upstream):
+    down, up = make_backend("down"), make_backend("up")
+    down.breaker.reset_timeout = 60
+    for _ in range(down.breaker.failure_threshold):
+        down.breaker.record_failure()
+    requests = upstream(lambda name, request: answered(name), Route([down, up]))
+    assert ask() == "answer from up"
+    assert requests == ["up"]
+
+
+def test_every_backend_unavailable_raises_upstream_unavailable(upstream):
+    upstream(lambda name, request: failed(503), Route([make_backend("a"), make_backend("b")]))
+    with pytest.raises(UpstreamUnavailable):
+        ask()
+
+
+def test_rejected_request_does_not_count_as_a_failure(upstream):
+    backend = make_backend("a")
+    upstream(lambda name, request: failed(400), Route([backend]))
+    with pytest.raises(ValueError) as raised:
+        ask()
+    assert not isinstance(raised.value, UpstreamUnavailable)
+    assert backend.breaker.failures == 0
+
+
+def test_missing_api_key_is_skipped_without_touching_the_breaker(upstream, monkeypatch):
+    monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
+    keyless, local = make_backend("keyless", provider="openrouter"), make_backend("local")
+    requests = upstream(lambda name, request: answered(name), Route([keyless, local]))
+    for _ in range(keyless.breaker.failure_threshold + 1):
+        assert ask() == "answer from local"
+    assert requests == ["local"] * (keyless.breaker.failure_threshold + 1)
+    assert keyless.breaker.stats() == {"state": "closed", "consecutive_failures": 0, "times_opened": 0}
+
+
+def test_missing_api_key_alone_is_a_configuration_error(upstream, monkeypatch):
+    monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
+    keyless = make_backend("keyless", provider="openrouter")
+    requests = upstream(lambda name, request: answered(name), Route([keyless]))
+    for _ in range(keyless.breaker.failure_threshold + 1):
+        with pytest.raises(ValueError, match="OPENROUTER_API_KEY") as raised:
+            ask()
+        assert not isinstance(raised.value, UpstreamUnavailable)
+    assert requests == []
+    assert keyless.breaker.state == "closed"
+
+
+def test_cancelled_caller_frees_the_half_open_trial(upstream):
+    backend = make_backend("a")
+    trip(backend)
+    started = []
+
+    async def handler(name, request):
+        started.append(name)
+        await asyncio.sleep(10)
+        return completion(name)
+
+    upstream(handler, Route([backend]))
+
+    async def scenario():
+        call = asyncio.create_task(llm_client.get_llm_responce("context", "question", context_tokens=10))
+        while not started:
+            await asyncio.sleep(0.01)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    asyncio.run(scenario())
+    assert backend.breaker.state == "half_open"
+    assert backend.breaker.allow()
+
+
+def test_stream_skips_a_misconfigured_backend(upstream, monkeypatch):
+    monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
+    keyless, local = make_backend("keyless", provider="openrouter"), make_backend("local")
+
+    async def handler(name, request):
+        body = 'data: {"choices": [{"delta": {"content": "streamed"}}]}\n\ndata: [DONE]\n\n'
+        return httpx.Response(200, content=body.encode(), headers={"Content-Type": "text/event-stream"})
+
+    requests = upstream(handler, Route([keyless, local]))
+
+    async def scenario():
+        return [delta async for delta in llm_client.stream_llm_responce("context", "question", context_tokens=10)]
+
+    assert asyncio.run(scenario()) == ["streamed"]
+    assert requests == ["local"]
+    assert keyless.breaker.state == "closed"
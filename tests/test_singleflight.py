@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from src.utils.singleflight import SingleFlight
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        started = 0
+        release = asyncio.Event()
+
+        async def call():
+            nonlocal started
+            started += 1
+            await release.wait()
+            return "answer"
+
+        callers = [asyncio.create_task(flight.do("key", call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers)
+        return started, results, flight.stats()
+
+    started, results, stats = run(scenario())
+    assert started == 1
+    assert [answer for answer, _ in results] == ["answer"] * 3
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    assert stats["calls"] == 1 and stats["coalesced"] == 2
+    assert stats["in_flight"] == 0 and stats["abandoned"] == 0
+
+
+def test_call_survives_while_any_waiter_remains():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        cancelled = False
+
+        async def call():
+            nonlocal cancelled
+            try:
+                await release.wait()
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            return "answer"
+
+        first = asyncio.create_task(flight.do("key", call))
+        second = asyncio.create_task(flight.do("key", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        answer, shared = await second
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return cancelled, answer, shared, flight.stats()
+
+    cancelled, answer, shared, stats = run(scenario())
+    assert not cancelled
+    assert (answer, shared) == ("answer", True)
+    assert stats["abandoned"] == 0
+
+
+def test_last_waiter_leaving_cancels_the_call():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("key", call)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        stats_after_abandon = flight.stats()
+
+        # A later caller must start a fresh call instead of joining the cancelled one
+        async def fresh():
+            return "fresh"
+
+        result = await flight.do("key", fresh)
+        return calls, stats_after_abandon, result
+
+    calls, stats, result = run(scenario())
+    assert calls == 1
+    assert stats["abandoned"] == 1 and stats["in_flight"] == 0
+    assert result == ("fresh", False)
+
+
+def test_start_and_leave_without_waiting():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.Event().wait()
+
+        task, shared = flight.start("key", call)
+        joined, joined_shared = flight.start("key", call)
+        flight.leave(task)
+        still_running = not task.done()
+        flight.leave(joined)
+        await asyncio.gather(task, return_exceptions=True)
+        return shared, joined is task, joined_shared, still_running, task.cancelled(), flight.stats()
+
+    shared, same_task, joined_shared, still_running, cancelled, stats = run(scenario())
+    assert not shared and same_task and joined_shared
+    assert still_running and cancelled
+    assert stats["abandoned"] == 1
+
+
+def test_failure_reaches_every_waiter_and_is_not_cached():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def failing():
+            await release.wait()
+            raise ValueError("upstream failed")
+
+        waiters = [asyncio.create_task(flight.do("key", failing)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+
+        async def succeeding():
+            return "ok"
+
+        return results, await flight.do("key", succeeding)
+
+    results, retry = run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert retry == ("ok", False)